@@ -0,0 +1,284 @@
+import math
+import pickle
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Generator, Iterable, List, Sequence, Tuple
+
+from heapfile import DiskManager, Record, Relation
+import metrics
+
+
+def _values(row) -> Tuple:
+    """Join operators yield plain tuples, scans yield Records."""
+    return row.values if isinstance(row, Record) else row
+
+
+class Aggregate:
+    """An aggregate over one column of the input rows.
+
+    The aggregate itself is stateless: init/step/merge work on a partial state,
+    so partial states computed separately (e.g. per heap file) can be merged.
+    """
+    name = None
+
+    def __init__(self, column: int = None):
+        self.column = column
+
+    def init(self):
+        raise NotImplementedError
+
+    def step(self, state, value):
+        raise NotImplementedError
+
+    def merge(self, state, other):
+        raise NotImplementedError
+
+    def result(self, state):
+        return state
+
+    def __repr__(self):
+        return f"{self.name}({'*' if self.column is None else self.column})"
+
+
+class Count(Aggregate):
+    """Number of rows, or of non-None values when a column is given."""
+    name = 'count'
+
+    def init(self):
+        return 0
+
+    def step(self, state, value):
+        return state + (value is not None or self.column is None)
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Sum(Aggregate):
+    name = 'sum'
+
+    def init(self):
+        return 0
+
+    def step(self, state, value):
+        return state + value
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Avg(Aggregate):
+    name = 'avg'
+
+    def init(self):
+        return (0, 0)  # sum, count
+
+    def step(self, state, value):
+        return (state[0] + value, state[1] + 1)
+
+    def merge(self, state, other):
+        return (state[0] + other[0], state[1] + other[1])
+
+    def result(self, state):
+        return state[0] / state[1] if state[1] else None
+
+
+class Min(Aggregate):
+    name = 'min'
+
+    def init(self):
+        return None
+
+    def step(self, state, value):
+        return value if state is None or value < state else state
+
+    def merge(self, state, other):
+        return other if state is None else self.step(state, other) if other is not None else state
+
+
+class Max(Aggregate):
+    name = 'max'
+
+    def init(self):
+        return None
+
+    def step(self, state, value):
+        return value if state is None or value > state else state
+
+    def merge(self, state, other):
+        return other if state is None else self.step(state, other) if other is not None else state
+
+
+class ApproxDistinct(Aggregate):
+    """Estimated number of distinct values (HyperLogLog with 2^precision registers).
+
+    The standard error is about 1.04 / sqrt(2^precision), ~1.6% with the default.
+    Values are hashed with blake2b so partial states from different processes merge.
+    """
+    name = 'approx_distinct'
+
+    def __init__(self, column: int = None, precision: int = 12):
+        super().__init__(column)
+        self.precision = precision
+
+    def init(self):
+        return bytearray(1 << self.precision)
+
+    def step(self, state, value):
+        h = int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), 'little')
+        register = h & ((1 << self.precision) - 1)
+        rest = h >> self.precision
+        rank = (64 - self.precision) - rest.bit_length() + 1  # position of the first 1 bit
+        if rank > state[register]:
+            state[register] = rank
+        return state
+
+    def merge(self, state, other):
+        return bytearray(max(a, b) for a, b in zip(state, other))
+
+    def result(self, state):
+        m = len(state)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in state)
+        zeros = state.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting for small cardinalities
+        return round(estimate)
+
+
+def _step(aggregates: Sequence[Aggregate], states: List, values: Tuple) -> None:
+    for i, aggregate in enumerate(aggregates):
+        if aggregate.column is None:
+            states[i] = aggregate.step(states[i], None)
+        else:
+            value = values[aggregate.column]
+            if value is not None:
+                states[i] = aggregate.step(states[i], value)
+
+
+def _merge_states(aggregates: Sequence[Aggregate], states: List, other: List) -> None:
+    for i, aggregate in enumerate(aggregates):
+        states[i] = aggregate.merge(states[i], other[i])
+
+
+def _results(aggregates: Sequence[Aggregate], states: List) -> Tuple:
+    return tuple(aggregate.result(state) for aggregate, state in zip(aggregates, states))
+
+
+def partial_aggregate(rows: Iterable, key: Sequence[int], aggregates: Sequence[Aggregate]) -> Dict[Tuple, List]:
+    """Groups rows by the key columns into {key: partial states}, for merge_partials."""
+    groups = {}
+    for row in rows:
+        values = _values(row)
+        group = tuple(values[column] for column in key)
+        states = groups.get(group)
+        if states is None:
+            states = groups[group] = [aggregate.init() for aggregate in aggregates]
+        _step(aggregates, states, values)
+    return groups
+
+
+def merge_partials(partials: Iterable[Dict[Tuple, List]], aggregates: Sequence[Aggregate]) -> Dict[Tuple, List]:
+    """Merges partial aggregates computed over disjoint parts of the input."""
+    merged = {}
+    for partial in partials:
+        for group, states in partial.items():
+            if group in merged:
+                _merge_states(aggregates, merged[group], states)
+            else:
+                merged[group] = states
+    return merged
+
+
+def finalize(groups: Dict[Tuple, List], aggregates: Sequence[Aggregate]) -> Generator[Tuple, None, None]:
+    """Yields (key, aggregate results) for every group."""
+    for group, states in groups.items():
+        yield group, _results(aggregates, states)
+
+
+@metrics.timed
+def hash_group_by(rows: Iterable, key: Sequence[int], aggregates: Sequence[Aggregate],
+                  max_groups: int = None, partitions: int = 16, spill_dir: str = None) -> Generator[Tuple, None, None]:
+    """Groups rows by the key columns in a hash table and yields (key, aggregate results).
+
+    If the table grows past max_groups, its partial states are spilled to
+    `partitions` files by hash of the key and the table is cleared. Each partition
+    is then merged on its own, so at most about max_groups / partitions * (number
+    of spills) states are held at once. Groups come out in no particular order.
+    """
+    groups = {}
+    spill_files = None
+
+    def spill():
+        nonlocal spill_files
+        if spill_files is None:
+            spill_files = [tempfile.TemporaryFile(dir=spill_dir) for _ in range(partitions)]
+        for group, states in groups.items():
+            pickle.dump((group, states), spill_files[hash(group) % partitions])
+        metrics.incr('groups_spilled', len(groups))
+        groups.clear()
+
+    for row in rows:
+        values = _values(row)
+        group = tuple(values[column] for column in key)
+        states = groups.get(group)
+        if states is None:
+            if max_groups is not None and len(groups) >= max_groups:
+                spill()
+            states = groups[group] = [aggregate.init() for aggregate in aggregates]
+        _step(aggregates, states, values)
+
+    if spill_files is None:
+        yield from finalize(groups, aggregates)
+        return
+
+    spill()
+    try:
+        for spill_file in spill_files:
+            spill_file.seek(0)
+            merged = {}
+            while True:
+                try:
+                    group, states = pickle.load(spill_file)
+                except EOFError:
+                    break
+                if group in merged:
+                    _merge_states(aggregates, merged[group], states)
+                else:
+                    merged[group] = states
+            yield from finalize(merged, aggregates)
+    finally:
+        for spill_file in spill_files:
+            spill_file.close()
+
+
+@metrics.timed
+def sorted_group_by(rows: Iterable, key: Sequence[int], aggregates: Sequence[Aggregate]) -> Generator[Tuple, None, None]:
+    """Streaming group-by for rows already sorted (or clustered) on the key columns.
+
+    Only the current group is held in memory; groups come out in input order.
+    """
+    current, states = None, None
+    for row in rows:
+        values = _values(row)
+        group = tuple(values[column] for column in key)
+        if group != current:
+            if states is not None:
+                yield current, _results(aggregates, states)
+            current, states = group, [aggregate.init() for aggregate in aggregates]
+        _step(aggregates, states, values)
+    if states is not None:
+        yield current, _results(aggregates, states)
+
+
+@metrics.timed
+def group_by_heap_files(disk_manager: DiskManager, relation: Relation, key: Sequence[int],
+                        aggregates: Sequence[Aggregate], predicate=None, workers: int = 1) -> Generator[Tuple, None, None]:
+    """Aggregates every heap file of the relation separately, then merges the partials."""
+    def aggregate_page(page_index):
+        return partial_aggregate(disk_manager.scan_page(relation, page_index, predicate), key, aggregates)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        partials = pool.map(aggregate_page, disk_manager.heap_pages(relation))
+        yield from finalize(merge_partials(partials, aggregates), aggregates)
@@ -0,0 +1,54 @@
+import math
+import hashlib
+from typing import Iterable
+
+
+class BloomFilter:
+    """Set membership with false positives but no false negatives."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing: the k positions are h1 + i * h2
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class KeyFilter:
+    """Summary of the join keys of one side of a join: min/max range plus a Bloom filter.
+
+    Built while scanning the build side and pushed into the scan of the probe side
+    (DiskManager.scan(..., key_filter=(column, KeyFilter))), so rows whose key cannot
+    match are dropped before they are decoded or probed.
+    """
+
+    def __init__(self, low, high, bloom: BloomFilter):
+        self.low = low
+        self.high = high
+        self.bloom = bloom
+
+    @classmethod
+    def build(cls, keys: Iterable, error_rate: float = 0.01) -> 'KeyFilter':
+        keys = set(keys)
+        bloom = BloomFilter(len(keys), error_rate)
+        for key in keys:
+            bloom.add(key)
+        return cls(min(keys, default=None), max(keys, default=None), bloom)
+
+    def may_contain(self, key) -> bool:
+        if self.low is None or key < self.low or key > self.high:
+            return False
+        return key in self.bloom
@@ -1,3 +1,11 @@
+import heapq
+import itertools
+import struct
+import threading
+from collections import OrderedDict
+
+import metrics
+
 class BPlusTreeNode:
     def __init__(self, is_leaf=False):
         self.is_leaf = is_leaf
@@ -52,6 +60,43 @@ class BPlusTree:
                     i += 1
             self._insert_non_full(node.children[i], value, record)
 
+    def bulk_load(self, entries):
+        """Builds the tree bottom-up from (key, record) entries sorted by key.
+
+        Nodes are filled to 2t-2 keys, leaving room for one insert before a split.
+        """
+        fill = max(2 * self.t - 2, 1)
+        leaves, separators = [BPlusTreeNode(is_leaf=True)], []
+        for entry in entries:
+            if len(leaves[-1].keys) == fill and len(separators) < len(leaves):
+                separators.append(entry)
+            else:
+                if len(separators) == len(leaves):
+                    leaves.append(BPlusTreeNode(is_leaf=True))
+                leaves[-1].keys.append(entry)
+        if len(separators) == len(leaves):
+            # the last entry became a separator with nothing after it
+            leaves[-1].keys.append(separators.pop())
+
+        nodes = leaves
+        while len(nodes) > 1:
+            parents, parent_separators = [BPlusTreeNode()], []
+            parents[-1].children.append(nodes[0])
+            for separator, child in zip(separators, nodes[1:]):
+                if len(parents[-1].keys) == fill:
+                    parent_separators.append(separator)
+                    parents.append(BPlusTreeNode())
+                else:
+                    parents[-1].keys.append(separator)
+                parents[-1].children.append(child)
+            if not parents[-1].keys and len(parents) > 1:
+                # fold a trailing single-child node into its (full-but-one) neighbour
+                last = parents.pop()
+                parents[-1].keys.append(parent_separators.pop())
+                parents[-1].children.append(last.children[0])
+            nodes, separators = parents, parent_separators
+        self.root = nodes[0]
+
     def scan(self):
         return self._scan_node(self.root, is_range_scan=False)
 
@@ -65,6 +110,7 @@ class BPlusTree:
     def _scan_node(self, node, is_range_scan, value=None, low=None, high=None):
         if not node:
             return
+        metrics.incr('index_node_visits')
         i = 0
         while i < len(node.keys):
             if not node.is_leaf:
@@ -82,3 +128,296 @@ class BPlusTree:
         
         if not node.is_leaf:
             yield from self._scan_node(node.children[i], is_range_scan, value, low, high)
+
+
+# Paged on-disk trees: page 0 holds the header, every other page holds one node
+INDEX_PAGE_SIZE = 4096
+INDEX_HEADER_FORMAT = 'III'  # root page, number of pages, t
+NODE_HEADER_FORMAT = '?H'  # is_leaf, number of keys
+NODE_HEADER_SIZE = struct.calcsize(NODE_HEADER_FORMAT)
+ENTRY_SIZE = struct.calcsize('ii')  # key, record id
+CHILD_SIZE = struct.calcsize('I')
+MAX_T = ((INDEX_PAGE_SIZE - NODE_HEADER_SIZE - CHILD_SIZE) // (ENTRY_SIZE + CHILD_SIZE) + 1) // 2
+
+
+class PagedBPlusTree:
+    """A BPlusTree whose nodes live in fixed-size pages of a file and are updated in place.
+
+    An operation reads only the nodes on its path and writes back the nodes it
+    changed when it completes. With buffer_size > 0 the tree is write-optimized:
+    inserts collect in an in-memory buffer that is applied as one sorted batch
+    when it fills, so each touched node is written once per batch. Buffered
+    entries are visible to searches but only reach the file on flush().
+    """
+
+    def __init__(self, path: str, buffer_size: int = 0, cache_pages: int = 1024):
+        self.path = path
+        self.file = open(path, 'rb+')
+        self.root, self.num_pages, self.t = struct.unpack_from(INDEX_HEADER_FORMAT, self.file.read(INDEX_PAGE_SIZE))
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.cache_pages = cache_pages
+        self.cache = OrderedDict()  # page -> node, least recently used first
+        self.dirty = set()
+        self.pinned = set()  # pages a write in progress has read; they stay cached until _commit
+        self.lock = threading.RLock()
+
+    @classmethod
+    def create(cls, path: str, entries=(), t: int = MAX_T, **kwargs) -> 'PagedBPlusTree':
+        """Writes a new tree bulk loaded from (key, record_id) entries sorted by key."""
+        t = min(t, MAX_T)
+        tree = BPlusTree(t)
+        tree.bulk_load(entries)
+        with open(path, 'wb') as file:
+            num_pages = 1
+
+            def assign(node):
+                nonlocal num_pages
+                node.page = num_pages
+                num_pages += 1
+                for child in node.children:
+                    assign(child)
+
+            def write(node):
+                file.seek(node.page * INDEX_PAGE_SIZE)
+                file.write(_pack_node(node, [child.page for child in node.children]))
+                for child in node.children:
+                    write(child)
+
+            assign(tree.root)
+            write(tree.root)
+            file.seek(0)
+            file.write(struct.pack(INDEX_HEADER_FORMAT, tree.root.page, num_pages, t).ljust(INDEX_PAGE_SIZE, b'\0'))
+        return cls(path, **kwargs)
+
+    def _node(self, page: int, pin: bool = False) -> BPlusTreeNode:
+        """Returns the node of a page. Writes pin the nodes they read, as they may change them."""
+        metrics.incr('index_node_visits')
+        if pin:
+            self.pinned.add(page)
+        node = self.cache.get(page)
+        if node is not None:
+            self.cache.move_to_end(page)
+        else:
+            self.file.seek(page * INDEX_PAGE_SIZE)
+            data = self.file.read(INDEX_PAGE_SIZE)
+            metrics.incr('index_pages_read')
+            is_leaf, num_keys = struct.unpack_from(NODE_HEADER_FORMAT, data)
+            node = BPlusTreeNode(is_leaf=is_leaf)
+            flat = struct.unpack_from(f'{2 * num_keys}i', data, NODE_HEADER_SIZE)
+            node.keys = list(zip(flat[0::2], flat[1::2]))
+            if not is_leaf:
+                node.children = list(struct.unpack_from(f'{num_keys + 1}I', data, NODE_HEADER_SIZE + num_keys * ENTRY_SIZE))
+            node.page = page
+            self.cache[page] = node
+            self._evict()
+        return node
+
+    def _new_node(self, is_leaf: bool) -> BPlusTreeNode:
+        node = BPlusTreeNode(is_leaf=is_leaf)
+        node.page = self.num_pages
+        self.num_pages += 1
+        self.cache[node.page] = node
+        self.dirty.add(node.page)
+        return node
+
+    def _commit(self):
+        for page in sorted(self.dirty):
+            node = self.cache[page]
+            self.file.seek(page * INDEX_PAGE_SIZE)
+            self.file.write(_pack_node(node, node.children))
+        metrics.incr('index_pages_written', len(self.dirty))
+        self.file.seek(0)
+        self.file.write(struct.pack(INDEX_HEADER_FORMAT, self.root, self.num_pages, self.t))
+        self.file.flush()
+        self.dirty.clear()
+        self.pinned.clear()
+        self._evict()
+
+    def _evict(self):
+        """Drops least recently used nodes until the cache fits in cache_pages.
+
+        Dirty and pinned nodes are kept until _commit, so a write never changes a
+        node that is no longer cached.
+        """
+        excess = len(self.cache) - self.cache_pages
+        if excess <= 0:
+            return
+        clean = (page for page in self.cache if page not in self.dirty and page not in self.pinned)
+        for page in list(itertools.islice(clean, excess)):
+            del self.cache[page]
+
+    def _split_child(self, parent: BPlusTreeNode, i: int):
+        t = self.t
+        node = self._node(parent.children[i], pin=True)
+        new_node = self._new_node(node.is_leaf)
+        parent.children.insert(i + 1, new_node.page)
+        parent.keys.insert(i, node.keys[t - 1])
+
+        new_node.keys = node.keys[t: (2 * t - 1)]
+        node.keys = node.keys[0: t - 1]
+
+        if not node.is_leaf:
+            new_node.children = node.children[t: 2 * t]
+            node.children = node.children[0: t]
+        self.dirty.update((parent.page, node.page))
+
+    def _insert(self, value, record):
+        node = self._node(self.root, pin=True)
+        if len(node.keys) == 2 * self.t - 1:
+            new_root = self._new_node(is_leaf=False)
+            new_root.children.append(node.page)
+            self.root = new_root.page
+            self._split_child(new_root, 0)
+            node = new_root
+        while True:
+            i = len(node.keys) - 1
+            while i >= 0 and value < node.keys[i][0]:
+                i -= 1
+            if node.is_leaf:
+                node.keys.insert(i + 1, (value, record))
+                self.dirty.add(node.page)
+                return
+            i += 1
+            if len(self._node(node.children[i], pin=True).keys) == 2 * self.t - 1:
+                self._split_child(node, i)
+                if value > node.keys[i][0]:
+                    i += 1
+            node = self._node(node.children[i], pin=True)
+
+    def insert(self, value, record):
+        with self.lock:
+            if self.buffer_size:
+                self.buffer.append((value, record))
+                if len(self.buffer) >= self.buffer_size:
+                    self.flush()
+                return
+            self._insert(value, record)
+            self._commit()
+
+    def insert_many(self, entries):
+        """Inserts a batch of entries in key order, writing each touched node once."""
+        with self.lock:
+            if self.buffer_size:
+                self.buffer.extend(entries)
+                if len(self.buffer) >= self.buffer_size:
+                    self.flush()
+                return
+            for value, record in sorted(entries, key=lambda entry: entry[0]):
+                self._insert(value, record)
+            self._commit()
+
+    def flush(self):
+        """Applies the buffered inserts to the tree."""
+        with self.lock:
+            if not self.buffer:
+                return
+            metrics.incr('index_buffer_flushes')
+            for value, record in sorted(self.buffer, key=lambda entry: entry[0]):
+                self._insert(value, record)
+            self.buffer = []
+            self._commit()
+
+    def _pop_max(self, page: int):
+        """Removes and returns the largest entry of a subtree, or None if it has none."""
+        node = self._node(page, pin=True)
+        if node.is_leaf:
+            if not node.keys:
+                return None
+            self.dirty.add(page)
+            return node.keys.pop()
+        entry = self._pop_max(node.children[-1])
+        if entry is None and node.keys:
+            # the rightmost subtree is empty: drop it along with the last key
+            node.children.pop()
+            entry = node.keys.pop()
+            self.dirty.add(page)
+        return entry
+
+    def _delete(self, page: int, value, record) -> bool:
+        node = self._node(page, pin=True)
+        for i, entry in enumerate(node.keys):
+            if entry == (value, record):
+                if node.is_leaf:
+                    del node.keys[i]
+                else:
+                    predecessor = self._pop_max(node.children[i])
+                    if predecessor is None:
+                        del node.keys[i]
+                        del node.children[i]
+                    else:
+                        node.keys[i] = predecessor
+                self.dirty.add(page)
+                return True
+        if node.is_leaf:
+            return False
+        for i in self._children_in_range(node, value, value):
+            if self._delete(node.children[i], value, record):
+                return True
+        return False
+
+    def delete(self, value, record) -> bool:
+        """Removes one (value, record) entry. Nodes may be left underfull; they are not merged."""
+        with self.lock:
+            if (value, record) in self.buffer:
+                self.buffer.remove((value, record))
+                return True
+            deleted = self._delete(self.root, value, record)
+            root = self._node(self.root, pin=True)
+            if not root.is_leaf and not root.keys:
+                self.root = root.children[0]
+            self._commit()
+            return deleted
+
+    def _children_in_range(self, node: BPlusTreeNode, low, high):
+        # equal keys can sit on both sides of a separator, so bounds are inclusive
+        num_keys = len(node.keys)
+        for i in range(num_keys + 1):
+            if (high is None or i == 0 or node.keys[i - 1][0] <= high) and \
+                    (low is None or i == num_keys or node.keys[i][0] >= low):
+                yield i
+
+    def _range(self, page: int, low, high):
+        node = self._node(page)
+        children = set(self._children_in_range(node, low, high)) if not node.is_leaf else ()
+        for i in range(len(node.keys) + 1):
+            if i in children:
+                yield from self._range(node.children[i], low, high)
+            if i < len(node.keys):
+                key = node.keys[i][0]
+                if high is not None and key > high:
+                    return
+                if low is None or key >= low:
+                    yield node.keys[i]
+
+    def _entries(self, low=None, high=None):
+        with self.lock:
+            entries = list(self._range(self.root, low, high))
+            buffered = sorted(entry for entry in self.buffer
+                              if (low is None or entry[0] >= low) and (high is None or entry[0] <= high))
+        if buffered:
+            return list(heapq.merge(entries, buffered, key=lambda entry: entry[0]))
+        return entries
+
+    def scan(self):
+        return self._entries()
+
+    def search(self, value):
+        return self._entries(value, value)
+
+    def range_search(self, low, high):
+        return self._entries(low, high)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.file.close()
+
+
+def _pack_node(node: BPlusTreeNode, children) -> bytes:
+    data = bytearray(struct.pack(NODE_HEADER_FORMAT, node.is_leaf, len(node.keys)))
+    for key, record_id in node.keys:
+        data.extend(struct.pack('ii', key, record_id))
+    if not node.is_leaf:
+        data.extend(struct.pack(f'{len(children)}I', *children))
+    return bytes(data.ljust(INDEX_PAGE_SIZE, b'\0'))
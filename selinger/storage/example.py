@@ -2,8 +2,7 @@ import random
 import string
 import time
 from heapfile import DiskManager, Relation, Record
-import os
-from bptree import BPlusTreeNode
+import metrics
 
 # Create a new relation R(name, age)
 relation_name = "R"
@@ -22,88 +21,49 @@ for _ in range(10000):
 # Define scan_all_heap method
 def scan_all_heap(disk_manager: DiskManager, relation: Relation) -> int:
     count = 0
-    for _ in disk_manager.scan(relation):
+    for _ in disk_manager.scan(relation, reuse_row=True):
         count += 1
     return count
 
 # Define scan_all_heap_predicate method
 def scan_all_heap_predicate(disk_manager: DiskManager, relation: Relation) -> int:
     count = 0
-    for _ in disk_manager.scan(relation, predicate=lambda record: record.values[1] > 50):
+    for _ in disk_manager.scan(relation, predicate=lambda record: record[1] > 50, reuse_row=True):
         count += 1
     return count
 
 # Define scan_all_index method
 def scan_all_index(disk_manager: DiskManager, relation: Relation) -> int:
-    count = 0
-    index_path = os.path.join(disk_manager.heap_dir, f"{relation.name}.idx")
-    
-    with open(index_path, 'rb') as index_file:
-        tree = disk_manager._deserialize_bplustree(index_file)
-        
-        def count_records(node: BPlusTreeNode):
-            nonlocal count
-            count += len(node.keys)
-            for child in node.children:
-                count_records(child)
-        
-        count_records(tree.root)
-    
-    return count
+    return len(disk_manager.index(relation, "age").scan())
 
 def scan_all_index_predicate(disk_manager: DiskManager, relation: Relation, predicate): # yield records that satisfy the predicate
-    index_path = os.path.join(disk_manager.heap_dir, f"{relation.name}.idx")
-    with open(index_path, 'rb') as index_file:
-        tree = disk_manager._deserialize_bplustree(index_file)
-        
-        def scan_records(node: BPlusTreeNode):
-            if node.is_leaf:
-                for key, record_id in node.keys:
-                    record = disk_manager.get_record(relation, record_id)
-                    if predicate(record):
-                        yield record
-            else:
-                for child in node.children:
-                    yield from scan_records(child)
-        
-        yield from scan_records(tree.root)
+    for key, record_id in disk_manager.index(relation, "age").scan():
+        record = disk_manager.get_record(relation, record_id)
+        if predicate(record):
+            yield record
 
 
 # Define scan_all_index_predicate method
 def scan_all_index_predicate_50(disk_manager: DiskManager, relation: Relation) -> int:
-    count = 0
-    column_index = next(i for i, (name, _) in enumerate(relation.schema) if name == "age")
-    
-    index_path = os.path.join(disk_manager.heap_dir, f"{relation.name}.idx")
-    
-    with open(index_path, 'rb') as index_file:
-        tree = disk_manager._deserialize_bplustree(index_file)
-        
-        def count_records(node: BPlusTreeNode):
-            nonlocal count
-            if node.is_leaf:
-                count += sum(1 for key, _ in node.keys if key > 50)
-            else:
-                for child in node.children:
-                    count_records(child)
-        
-        count_records(tree.root)
-    
-    return count
+    return len(disk_manager.index(relation, "age").range_search(51, None))
 
 
 
 # Benchmark scan_all_heap
 start_time = time.time()
-total_records_heap = scan_all_heap(disk_manager, relation)
+with metrics.collect('scan_all_heap') as stats:
+    total_records_heap = scan_all_heap(disk_manager, relation)
 elapsed_time = time.time() - start_time
 print(f"scan_all_heap: {total_records_heap} records, Time: {elapsed_time} seconds")
+print(stats.report())
 
 # Benchmark scan_all_heap_predicate
 start_time = time.time()
-total_records_heap_predicate = scan_all_heap_predicate(disk_manager, relation)
+with metrics.collect('scan_all_heap_predicate') as stats:
+    total_records_heap_predicate = scan_all_heap_predicate(disk_manager, relation)
 elapsed_time = time.time() - start_time
 print(f"scan_all_heap_predicate: {total_records_heap_predicate} records, Time: {elapsed_time} seconds")
+print(stats.report())
 
 # Create index on age column
 disk_manager.make_index(relation, "age")
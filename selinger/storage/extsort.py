@@ -0,0 +1,233 @@
+import heapq
+import pickle
+import struct
+import tempfile
+from typing import Any, Callable, Generator, Iterable, List, Sequence
+
+import metrics
+
+DEFAULT_MEMORY_LIMIT = 16 << 20  # bytes of serialized rows per run
+DEFAULT_FAN_IN = 64  # runs merged at once
+SPILL_BUFFER_SIZE = 1 << 16
+
+
+class PickleCodec:
+    """Spills any picklable row, each prefixed with its length."""
+    LENGTH_FORMAT = 'I'
+    LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+
+    def size(self, row) -> int:
+        return self.LENGTH_SIZE + len(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+
+    def write(self, file, row) -> None:
+        data = pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+        file.write(struct.pack(self.LENGTH_FORMAT, len(data)))
+        file.write(data)
+
+    def read(self, file) -> Generator[Any, None, None]:
+        while True:
+            header = file.read(self.LENGTH_SIZE)
+            if not header:
+                return
+            yield pickle.loads(file.read(struct.unpack(self.LENGTH_FORMAT, header)[0]))
+
+
+class StructCodec:
+    """Spills fixed-length tuples, e.g. StructCodec('ii') for (key, record_id) index entries."""
+
+    def __init__(self, fmt: str):
+        self.struct = struct.Struct(fmt)
+
+    def size(self, row) -> int:
+        return self.struct.size
+
+    def write(self, file, row) -> None:
+        file.write(self.struct.pack(*row))
+
+    def read(self, file) -> Generator[tuple, None, None]:
+        while True:
+            data = file.read(self.struct.size)
+            if not data:
+                return
+            yield self.struct.unpack(data)
+
+
+class RecordCodec:
+    """Spills Records of a relation in the heap page record format, prefixed with record id and length."""
+    HEADER = struct.Struct('iH')
+
+    def __init__(self, disk_manager, relation):
+        self.disk_manager = disk_manager
+        self.relation = relation
+
+    def size(self, row) -> int:
+        return self.HEADER.size + self.relation.record_length(row.values)
+
+    def write(self, file, row) -> None:
+        data = self.disk_manager._serialize_record(self.relation, row.values)
+        file.write(self.HEADER.pack(row.record_id, len(data)))
+        file.write(data)
+
+    def read(self, file) -> Generator[Any, None, None]:
+        while True:
+            header = file.read(self.HEADER.size)
+            if not header:
+                return
+            record_id, length = self.HEADER.unpack(header)
+            yield self.disk_manager._deserialize_record(self.relation, file.read(length), record_id)
+
+
+class _Reversed:
+    """Inverts the ordering of a key, for descending heaps."""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class _Run:
+    def __init__(self, codec, spill_dir: str):
+        self.codec = codec
+        self.file = tempfile.TemporaryFile(dir=spill_dir, buffering=SPILL_BUFFER_SIZE)
+
+    def write(self, row) -> None:
+        self.codec.write(self.file, row)
+
+    def rows(self) -> Generator[Any, None, None]:
+        self.file.seek(0)
+        yield from self.codec.read(self.file)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def column_key(relation, column_names: Sequence[str]) -> Callable:
+    """Sort key of Records of the relation on the named columns."""
+    columns = [relation.column_index(name) for name in column_names]
+    if len(columns) == 1:
+        column = columns[0]
+        return lambda record: record.values[column]
+    return lambda record: tuple(record.values[column] for column in columns)
+
+
+def top_k(rows: Iterable, key: Callable, k: int, reverse: bool = False) -> List:
+    """The first k rows in sort order, keeping only k rows in memory."""
+    if reverse:
+        return heapq.nlargest(k, rows, key=key)
+    return heapq.nsmallest(k, rows, key=key)
+
+
+def _sorted_runs(rows: Iterable, key: Callable, codec, memory_limit: int, reverse: bool,
+                 spill_dir: str, runs: List[_Run]) -> List:
+    """Writes sorted runs of up to memory_limit bytes; returns the last run if it still fits in memory."""
+    buffer, size = [], 0
+    for row in rows:
+        buffer.append(row)
+        size += codec.size(row)
+        if size >= memory_limit:
+            buffer.sort(key=key, reverse=reverse)
+            run = _Run(codec, spill_dir)
+            for buffered in buffer:
+                run.write(buffered)
+            runs.append(run)
+            buffer, size = [], 0
+    buffer.sort(key=key, reverse=reverse)
+    return buffer
+
+
+def _replacement_selection_runs(rows: Iterable, key: Callable, codec, memory_limit: int, reverse: bool,
+                                spill_dir: str, runs: List[_Run]) -> List:
+    """Writes runs with a heap: a row joins the current run if it sorts after the last one written.
+
+    On random input runs average twice the memory budget, and sorted input gives a single run.
+    """
+    wrap = _Reversed if reverse else (lambda k: k)
+    rows = iter(rows)
+    heap, size, seq = [], 0, 0
+    for row in rows:
+        heap.append((0, wrap(key(row)), seq, row))
+        seq += 1
+        size += codec.size(row)
+        if size >= memory_limit:
+            break
+    else:
+        # the whole input fit in memory
+        heap.sort()
+        return [entry[3] for entry in heap]
+
+    heapq.heapify(heap)
+    run_number, run = 0, _Run(codec, spill_dir)
+    runs.append(run)
+    while heap:
+        number, row_key, _, row = heapq.heappop(heap)
+        if number != run_number:
+            run_number, run = number, _Run(codec, spill_dir)
+            runs.append(run)
+        run.write(row)
+        for next_row in rows:
+            next_key = wrap(key(next_row))
+            next_number = run_number + 1 if next_key < row_key else run_number
+            heapq.heappush(heap, (next_number, next_key, seq, next_row))
+            seq += 1
+            break
+    return []
+
+
+def _merge(sources: List[Iterable], key: Callable, reverse: bool) -> Iterable:
+    return heapq.merge(*sources, key=key, reverse=reverse)
+
+
+@metrics.timed
+def external_sort(rows: Iterable, key: Callable, memory_limit: int = DEFAULT_MEMORY_LIMIT,
+                  fan_in: int = DEFAULT_FAN_IN, replacement_selection: bool = False, reverse: bool = False,
+                  limit: int = None, codec=None, spill_dir: str = None) -> Generator[Any, None, None]:
+    """Sorts rows by key using at most about memory_limit bytes of (serialized) rows.
+
+    Input beyond the budget is written to sorted runs in temporary files, using
+    `codec` (PickleCodec by default; StructCodec or RecordCodec are more compact).
+    Runs are then merged fan_in at a time with a k-way heap merge, over several
+    passes if there are more than fan_in runs. With limit=k only the first k rows
+    are produced, using a bounded heap instead of spilling.
+
+    The whole input is consumed before the first row is produced.
+    """
+    if limit is not None:
+        yield from top_k(rows, key, limit, reverse)
+        return
+    codec = codec or PickleCodec()
+    fan_in = max(fan_in, 2)
+    runs = []
+    try:
+        generate = _replacement_selection_runs if replacement_selection else _sorted_runs
+        in_memory = generate(rows, key, codec, memory_limit, reverse, spill_dir, runs)
+        metrics.incr('sort_runs', len(runs))
+        if not runs:
+            yield from in_memory
+            return
+
+        # Intermediate passes merge the oldest runs first until one pass can finish the sort
+        while len(runs) + bool(in_memory) > fan_in:
+            merged = _Run(codec, spill_dir)
+            for row in _merge([run.rows() for run in runs[:fan_in]], key, reverse):
+                merged.write(row)
+            for run in runs[:fan_in]:
+                run.close()
+            runs = runs[fan_in:] + [merged]
+            metrics.incr('sort_intermediate_merges')
+
+        yield from _merge([run.rows() for run in runs] + [in_memory], key, reverse)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def sort_relation(disk_manager, relation, column_names: Sequence[str], **kwargs) -> Generator[Any, None, None]:
+    """Scans a relation and yields its Records sorted on the named columns."""
+    codec = RecordCodec(disk_manager, relation)
+    return external_sort(disk_manager.scan(relation), column_key(relation, column_names), codec=codec, **kwargs)
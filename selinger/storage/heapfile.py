@@ -1,53 +1,396 @@
 import os
+import json
 import struct
 import itertools
-from typing import List, Tuple, Generator, Callable
-from bptree import BPlusTree, BPlusTreeNode
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Tuple, Generator, Callable
+from bptree import PagedBPlusTree
+from extsort import external_sort, StructCodec, DEFAULT_MEMORY_LIMIT
+import metrics
 
 # Constants
-CHAR_SIZE = 32
 BOOL_SIZE = 1
 INT_SIZE = 4
-MAX_RECORDS_PER_PAGE = 100
+STRING_LENGTH_FORMAT = 'H'  # strings are stored as their utf-8 length followed by the bytes
+STRING_LENGTH_SIZE = struct.calcsize(STRING_LENGTH_FORMAT)
+
+# Slotted pages: a header and a slot array grow from the start of the page,
+# the records they point to grow down from the end
+PAGE_SIZE = 4096
+PAGE_HEADER_FORMAT = 'HH'  # number of slots, start of the record area
+PAGE_HEADER_SIZE = struct.calcsize(PAGE_HEADER_FORMAT)
+SLOT_FORMAT = 'HH'  # record offset and length; offset 0 marks an empty slot
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+SLOT_BITS = 12  # a page has fewer than (PAGE_SIZE - PAGE_HEADER_SIZE) / SLOT_SIZE < 2^12 slots
+
+
+def make_record_id(page_index: int, slot: int) -> int:
+    return (page_index << SLOT_BITS) | slot
+
+
+def split_record_id(record_id: int) -> Tuple[int, int]:
+    return record_id >> SLOT_BITS, record_id & ((1 << SLOT_BITS) - 1)
 
 
 class Record:
-    def __init__(self, relation_name: str, record_id: int, values: Tuple):
-        self.relation_name = relation_name
-        self.record_id = record_id  # record_id has the first 12 bits as page number
-        self.values = values
+    """A record of a relation, decoded lazily from its serialized bytes.
+
+    Records point to their Relation rather than copying its name. record[i]
+    decodes just field i; record.values decodes every field, once.
+    """
+    __slots__ = ('relation', 'record_id', '_data', '_values')
+
+    def __init__(self, relation: 'Relation', record_id: int, values: Tuple = None, data: bytes = None):
+        self.relation = relation
+        self.record_id = record_id  # (page, slot), see make_record_id
+        self._data = data
+        self._values = values
+
+    def load(self, record_id: int, data: bytes) -> 'Record':
+        """Points the record at another serialized record, for scans that reuse one row."""
+        self.record_id = record_id
+        self._data = data
+        self._values = None
+        return self
+
+    @property
+    def relation_name(self) -> str:
+        return self.relation.name
+
+    @property
+    def values(self) -> Tuple:
+        if self._values is None:
+            metrics.incr('records_decoded')
+            self._values = self.relation.decode(self._data)
+        return self._values
+
+    def __getitem__(self, column_index: int):
+        if self._values is not None:
+            return self._values[column_index]
+        reader = self.relation._readers.get(column_index) or self.relation.field_reader(column_index)
+        return reader(self._data)
+
+    def __repr__(self) -> str:
+        return f"Record({self.relation.name}, {self.record_id}, {self.values})"
 
 
 class Relation:
     def __init__(self, name: str, schema: List[Tuple[str, str]]):
         self.name = name
         self.schema = schema
+        self._readers = {}  # column index -> field reader, built on first use
+        self._fixed = None  # struct of the whole record if it has no strings
+
+    def __getstate__(self) -> dict:
+        # the decoders are closures, so they are rebuilt rather than pickled
+        return {'name': self.name, 'schema': self.schema}
 
-    def record_length(self) -> int:
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['name'], state['schema'])
+
+    def record_length(self, values: Tuple) -> int:
+        """Serialized size of a record with these values."""
         length = 0
-        for _, typ in self.schema:
+        for (_, typ), value in zip(self.schema, values):
             if typ == 'string':
-                length += CHAR_SIZE
+                length += STRING_LENGTH_SIZE + len(value.encode('utf-8'))
             elif typ == 'bool':
                 length += BOOL_SIZE
             elif typ == 'int':
                 length += INT_SIZE
-        return length + INT_SIZE  # Extra space for record_id
+        return length
+
+    def column_index(self, column_name: str) -> int:
+        return next(i for i, (name, _) in enumerate(self.schema) if name == column_name)
+
+    def field_offset(self, column_index: int, data: bytes) -> int:
+        """Byte offset of a field within a serialized record."""
+        offset = 0
+        for _, typ in self.schema[:column_index]:
+            if typ == 'string':
+                offset += STRING_LENGTH_SIZE + struct.unpack_from(STRING_LENGTH_FORMAT, data, offset)[0]
+            else:
+                offset += BOOL_SIZE if typ == 'bool' else INT_SIZE
+        return offset
+
+    def field_reader(self, column_index: int) -> Callable[[bytes], object]:
+        """A function decoding one field of a serialized record.
+
+        Fields before the first string have a constant offset, so their readers
+        unpack directly; later fields skip over the strings before them.
+        """
+        reader = self._readers.get(column_index)
+        if reader is not None:
+            return reader
+        typ = self.schema[column_index][1]
+        # bytes to skip before the field: runs of fixed-size fields, and None for each string
+        steps = []
+        for _, field_type in self.schema[:column_index]:
+            if field_type == 'string':
+                steps.append(None)
+            elif steps and steps[-1] is not None:
+                steps[-1] += BOOL_SIZE if field_type == 'bool' else INT_SIZE
+            else:
+                steps.append(BOOL_SIZE if field_type == 'bool' else INT_SIZE)
+        unpack_length = struct.Struct(STRING_LENGTH_FORMAT).unpack_from
+        unpack = unpack_length if typ == 'string' else struct.Struct('?' if typ == 'bool' else 'i').unpack_from
+
+        if None not in steps and typ != 'string':
+            fixed_offset = sum(steps)
+
+            def reader(data: bytes):
+                return unpack(data, fixed_offset)[0]
+        else:
+            def reader(data: bytes):
+                offset = 0
+                for size in steps:
+                    offset += STRING_LENGTH_SIZE + unpack_length(data, offset)[0] if size is None else size
+                value = unpack(data, offset)[0]
+                if typ == 'string':
+                    offset += STRING_LENGTH_SIZE
+                    return data[offset:offset + value].decode('utf-8')
+                return value
+        self._readers[column_index] = reader
+        return reader
+
+    def decode(self, data: bytes) -> Tuple:
+        """All the fields of a serialized record."""
+        if self._fixed is None:
+            if any(typ == 'string' for _, typ in self.schema):
+                self._fixed = False
+            else:
+                # '=' packs fields without alignment, like the field by field encoding
+                self._fixed = struct.Struct('=' + ''.join('?' if typ == 'bool' else 'i' for _, typ in self.schema))
+        if self._fixed:
+            return self._fixed.unpack(data)
+        offset = 0
+        values = []
+        for _, attr_type in self.schema:
+            if attr_type == 'string':
+                length = struct.unpack_from(STRING_LENGTH_FORMAT, data, offset)[0]
+                offset += STRING_LENGTH_SIZE
+                value = data[offset:offset + length].decode('utf-8')
+                offset += length
+            elif attr_type == 'bool':
+                value = struct.unpack_from('?', data, offset)[0]
+                offset += BOOL_SIZE
+            else:
+                value = struct.unpack_from('i', data, offset)[0]
+                offset += INT_SIZE
+            values.append(value)
+        return tuple(values)
 
 
 class Page:
-    def __init__(self, records: List[Record]):
-        self.records = records
+    """A slotted heap page.
+
+    Slot numbers never change while a record lives, so records can be moved
+    within the page (compact) without changing their record ids. Deleted slots
+    are reused by later inserts.
+    """
+
+    def __init__(self, data: bytes = None):
+        if data:
+            self.data = bytearray(data)
+        else:
+            self.data = bytearray(PAGE_SIZE)
+            struct.pack_into(PAGE_HEADER_FORMAT, self.data, 0, 0, PAGE_SIZE)
+        self._free_slots = None  # empty slots and live record bytes, computed on first write
+        self._live_bytes = None
+
+    @property
+    def num_slots(self) -> int:
+        return struct.unpack_from(PAGE_HEADER_FORMAT, self.data, 0)[0]
+
+    def _slot(self, slot: int) -> Tuple[int, int]:
+        return struct.unpack_from(SLOT_FORMAT, self.data, PAGE_HEADER_SIZE + slot * SLOT_SIZE)
+
+    def _set_slot(self, slot: int, offset: int, length: int) -> None:
+        struct.pack_into(SLOT_FORMAT, self.data, PAGE_HEADER_SIZE + slot * SLOT_SIZE, offset, length)
+
+    def get(self, slot: int) -> bytes:
+        """The record stored in the slot, or None if the slot is empty."""
+        if slot >= self.num_slots:
+            return None
+        offset, length = self._slot(slot)
+        return bytes(self.data[offset:offset + length]) if offset else None
+
+    def records(self) -> Generator[Tuple[int, bytes], None, None]:
+        """Yields (slot, record) for every live record."""
+        data = self.data
+        for slot, (offset, length) in enumerate(struct.iter_unpack(
+                SLOT_FORMAT, data[PAGE_HEADER_SIZE:PAGE_HEADER_SIZE + self.num_slots * SLOT_SIZE])):
+            if offset:
+                yield slot, bytes(data[offset:offset + length])
+
+    def _space_map(self) -> None:
+        if self._free_slots is None:
+            self._free_slots, self._live_bytes = [], 0
+            for slot in range(self.num_slots):
+                offset, length = self._slot(slot)
+                if offset:
+                    self._live_bytes += length
+                else:
+                    self._free_slots.append(slot)
 
     def has_space(self, record_length: int) -> bool:
-        return len(self.records) < MAX_RECORDS_PER_PAGE
+        """Whether a record of record_length bytes fits, after compaction if necessary."""
+        self._space_map()
+        slot_array = PAGE_HEADER_SIZE + self.num_slots * SLOT_SIZE
+        needed = record_length + (0 if self._free_slots else SLOT_SIZE)
+        return PAGE_SIZE - slot_array - self._live_bytes >= needed
+
+    def insert(self, record: bytes) -> int:
+        """Stores the record and returns its slot; compacts the page if the free space is fragmented."""
+        if not self.has_space(len(record)):
+            raise ValueError(f"Record of {len(record)} bytes does not fit in the page.")
+        num_slots, start = struct.unpack_from(PAGE_HEADER_FORMAT, self.data, 0)
+        if self._free_slots:
+            slot = self._free_slots.pop(0)
+        else:
+            slot, num_slots = num_slots, num_slots + 1
+        if start - len(record) < PAGE_HEADER_SIZE + num_slots * SLOT_SIZE:
+            self.compact()
+            start = struct.unpack_from(PAGE_HEADER_FORMAT, self.data, 0)[1]
+        start -= len(record)
+        self.data[start:start + len(record)] = record
+        self._set_slot(slot, start, len(record))
+        struct.pack_into(PAGE_HEADER_FORMAT, self.data, 0, num_slots, start)
+        self._live_bytes += len(record)
+        return slot
+
+    def delete(self, slot: int) -> None:
+        record = self.get(slot)
+        if record is None:
+            raise ValueError(f"Slot {slot} is empty.")
+        self._space_map()
+        self._set_slot(slot, 0, 0)
+        self._free_slots.append(slot)
+        self._free_slots.sort()
+        self._live_bytes -= len(record)
+
+    def compact(self) -> None:
+        """Moves the live records to the end of the page, leaving one contiguous free area."""
+        num_slots = self.num_slots
+        records = list(self.records())
+        start = PAGE_SIZE
+        for slot, record in records:
+            start -= len(record)
+            self.data[start:start + len(record)] = record
+            self._set_slot(slot, start, len(record))
+        struct.pack_into(PAGE_HEADER_FORMAT, self.data, 0, num_slots, start)
+        metrics.incr('pages_compacted')
+
+
+class PageLatch:
+    """Shared/exclusive latch on one heap page: many readers or a single writer."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+
+    @contextmanager
+    def shared(self):
+        with self._condition:
+            while self._writer:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._condition:
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class Cursor:
+    """A scan position over one relation with its own pinned page buffer.
+
+    Pages are copied out under a shared latch and decoded from the copy, so a
+    cursor is unaffected by other cursors, by inserts and by other threads.
+    """
+
+    def __init__(self, disk_manager: 'DiskManager', relation: Relation):
+        self.disk_manager = disk_manager
+        self.relation = relation
+        self.page_index = None
+        self.page = None
+
+    def pin(self, page_index: int) -> Page:
+        """Returns the page, reading it unless it is already pinned."""
+        if page_index != self.page_index:
+            self.page = Page(self.disk_manager._read_page(self.relation, page_index))
+            self.page_index = page_index
+        return self.page
+
+    def fetch(self, record_id: int) -> Record:
+        page_index, slot = split_record_id(record_id)
+        record_data = self.pin(page_index).get(slot)
+        if record_data is None:
+            raise ValueError(f"Record at ID {record_id} not found.")
+        return self.disk_manager._deserialize_record(self.relation, record_data, record_id)
+
+    def scan_page(self, page_index: int, predicate: Callable[[Record], bool] = None,
+                  key_filter: Tuple[str, object] = None, reuse_row: bool = False) -> Generator[Record, None, None]:
+        key_matches = self.disk_manager._key_matcher(self.relation, key_filter)
+        row = Record(self.relation, None) if reuse_row else None
+        for slot, record_data in self.pin(page_index).records():
+            if key_matches is not None and not key_matches(record_data):
+                continue
+            record_id = make_record_id(page_index, slot)
+            record = Record(self.relation, record_id, data=record_data) if row is None else row.load(record_id, record_data)
+            if predicate is None or predicate(record):
+                yield record
+
+    def scan(self, predicate: Callable[[Record], bool] = None,
+             key_filter: Tuple[str, object] = None, reuse_row: bool = False) -> Generator[Record, None, None]:
+        for page_index in self.disk_manager.heap_pages(self.relation):
+            yield from self.scan_page(page_index, predicate, key_filter, reuse_row)
+        self.close()
+
+    def close(self) -> None:
+        self.page_index, self.page = None, None
 
 
 class DiskManager:
+    """Heap files and indexes of relations.
+
+    Every heap file is one slotted Page of PAGE_SIZE bytes. Indexes are paged
+    trees registered in heap/catalog.json and kept up to date by every insert
+    and delete. A DiskManager can be shared by many threads: every scan reads
+    through its own Cursor, writes are serialized by a lock, and each heap page
+    has a PageLatch so pages are never read while they are being written.
+    """
+
     def __init__(self):
         self.heap_dir = 'heap'
-        self.current_heap_file = None
-        self.current_page_index = -1
+        self.current_heap_file = None  # handle of the page writes go to
+        self.current_page = None  # and its contents
+        self.insert_pages = {}  # relation name -> first page inserts try
+        self.insert_lock = threading.RLock()
+        self.latches = {}
+        self.latches_lock = threading.Lock()
+        self.catalog = None  # loaded on first use
+        self.open_indexes = {}  # (relation name, column name) -> PagedBPlusTree
+        self.catalog_lock = threading.RLock()
 
     def _get_heap_file_path(self, relation_name: str, index: int) -> str:
         return os.path.join(self.heap_dir, f"{relation_name}_{index}.heap")
@@ -55,141 +398,275 @@ class DiskManager:
     def _open_heap_file(self, path: str):
         if self.current_heap_file:
             self.current_heap_file.close()
-        self.current_heap_file = open(path, 'ab+')
-
-    def _create_new_page(self, relation: Relation) -> Page:
-        return Page([])
-
+        if os.path.exists(path):
+            self.current_heap_file = open(path, 'rb+')
+            self.current_page = Page(self.current_heap_file.read())
+        else:
+            self.current_heap_file = open(path, 'wb+')
+            self.current_page = self._create_new_page()
+        metrics.incr('heap_file_opens')
+
+    def _write_current_page(self, relation: Relation, page_index: int):
+        # flush so readers, which use their own handles, see the write
+        with self.latch(relation.name, page_index).exclusive():
+            self.current_heap_file.seek(0)
+            self.current_heap_file.write(self.current_page.data)
+            self.current_heap_file.flush()
+
+    def _create_new_page(self) -> Page:
+        return Page()
+
+    def latch(self, relation_name: str, page_index: int) -> PageLatch:
+        with self.latches_lock:
+            latch = self.latches.get((relation_name, page_index))
+            if latch is None:
+                latch = self.latches[(relation_name, page_index)] = PageLatch()
+            return latch
+
+    def cursor(self, relation: Relation) -> Cursor:
+        return Cursor(self, relation)
+
+    @metrics.timed
     def get_record(self, relation: Relation, record_id: int) -> Record:
-        # Extract page index and record offset from the record_id
-        page_index = record_id >> 20  # Get the first 12 bits for the page index
-        record_offset = record_id & ((1 << 20) - 1)  # Get the last 20 bits for the offset
-
-        # Open the correct heap file for the relation and page index
-        heap_file_path = self._get_heap_file_path(relation.name, page_index)
-
-        # Open the heap file in binary read mode
-        with open(heap_file_path, 'rb') as heap_file:
-            # Calculate the position to seek to based on the record offset
-            record_length = relation.record_length()
-            position = record_offset * record_length
-
-            # Move the file pointer to the desired position
-            heap_file.seek(position)
-
-            # Read the record data
-            record_data = heap_file.read(record_length)
-
-            if not record_data:
-                raise ValueError(f"Record at ID {record_id} not found.")
-
-            # Deserialize the record
-            return self._deserialize_record(relation, record_data)
+        return self.cursor(relation).fetch(record_id)
 
     def insert_record(self, relation: Relation, values: Tuple) -> int:
-        record_length = relation.record_length()
-
-        # Find the first page with space or create a new page
-        while True:
-            self.current_page_index += 1
-            path = self._get_heap_file_path(relation.name, self.current_page_index)
-            if not os.path.exists(path):
+        return self.insert_records(relation, [values])[0]
+
+    def insert_records(self, relation: Relation, rows: Iterable[Tuple]) -> List[int]:
+        """Inserts records and adds them to the relation's indexes.
+
+        Each heap page is written once per call and each index applies its new
+        entries as one sorted batch, so bulk loads should pass many rows at once.
+        """
+        inserted = []
+        with self.insert_lock:
+            # Find the first page with space or create a new page, starting from
+            # the page this relation's last insert went to
+            page_index = self.insert_pages.get(relation.name, 0)
+            path = self._get_heap_file_path(relation.name, page_index)
+            if self.current_heap_file is None or self.current_heap_file.name != path:
                 self._open_heap_file(path)
-                page = self._create_new_page(relation)
-                break
-            else:
+            dirty = False
+            for values in rows:
+                record_data = self._serialize_record(relation, values)
+                if len(record_data) + SLOT_SIZE > PAGE_SIZE - PAGE_HEADER_SIZE:
+                    raise ValueError(f"Record of {len(record_data)} bytes does not fit in a page.")
+                while not self.current_page.has_space(len(record_data)):
+                    if dirty:
+                        self._write_current_page(relation, page_index)
+                        dirty = False
+                    page_index += 1
+                    self._open_heap_file(self._get_heap_file_path(relation.name, page_index))
+                slot = self.current_page.insert(record_data)
+                dirty = True
+                inserted.append((values, make_record_id(page_index, slot)))
+            if dirty:
+                self._write_current_page(relation, page_index)
+            self.insert_pages[relation.name] = page_index
+            metrics.incr('records_written', len(inserted))
+
+            for column_name, index in self.indexes(relation):
+                column_index = relation.column_index(column_name)
+                index.insert_many([(values[column_index], record_id) for values, record_id in inserted])
+
+        return [record_id for _, record_id in inserted]
+
+    def _modify_page(self, relation: Relation, page_index: int, modify: Callable[[Page], object]):
+        path = self._get_heap_file_path(relation.name, page_index)
+        if not os.path.exists(path):
+            raise ValueError(f"Page {page_index} of relation {relation.name} not found.")
+        with self.insert_lock:
+            if self.current_heap_file is None or self.current_heap_file.name != path:
                 self._open_heap_file(path)
-                self.current_heap_file.seek(0, os.SEEK_END)
-                if self.current_heap_file.tell() < MAX_RECORDS_PER_PAGE * record_length:
-                    break
-
-        # Calculate record offset in the current page
-        record_offset = self.current_heap_file.tell() // record_length
-        record_id = (self.current_page_index << 20) | record_offset  # First 12 bits are page number, last 20 bits are offset
-
-        # Create the record
-        record = Record(relation.name, record_id, values)
+            result = modify(self.current_page)
+            self._write_current_page(relation, page_index)
+            # freed space is reused by later inserts
+            self.insert_pages[relation.name] = min(self.insert_pages.get(relation.name, 0), page_index)
+            return result
+
+    def delete_record(self, relation: Relation, record_id: int):
+        """Empties the record's slot and removes it from the relation's indexes.
+
+        The space is reclaimed when the page is compacted.
+        """
+        page_index, slot = split_record_id(record_id)
+
+        def delete(page: Page) -> bytes:
+            record_data = page.get(slot)
+            if record_data is None:
+                raise ValueError(f"Record at ID {record_id} not found.")
+            page.delete(slot)
+            return record_data
 
-        # Insert record
-        self.current_heap_file.write(self._serialize_record(relation, record))
+        with self.insert_lock:
+            values = self._deserialize_record(relation, self._modify_page(relation, page_index, delete), record_id).values
+            for column_name, index in self.indexes(relation):
+                index.delete(values[relation.column_index(column_name)], record_id)
 
-        return record_id
+    def compact_page(self, relation: Relation, page_index: int):
+        self._modify_page(relation, page_index, Page.compact)
 
-    def _serialize_record(self, relation: Relation, record: Record) -> bytes:
+    def _serialize_record(self, relation: Relation, values: Tuple) -> bytes:
         serialized = bytearray()
-        # Serialize the record_id first
-        serialized.extend(struct.pack('i', record.record_id))
-        for (attr_name, attr_type), value in zip(relation.schema, record.values):
+        for (attr_name, attr_type), value in zip(relation.schema, values):
             if attr_type == 'string':
-                serialized.extend(struct.pack(f'{CHAR_SIZE}s', value.encode('utf-8')))
+                encoded = value.encode('utf-8')
+                serialized.extend(struct.pack(STRING_LENGTH_FORMAT, len(encoded)))
+                serialized.extend(encoded)
             elif attr_type == 'bool':
                 serialized.extend(struct.pack('?', value))
             elif attr_type == 'int':
                 serialized.extend(struct.pack('i', value))
-        return serialized
-
-    def scan(self, relation: Relation, predicate: Callable[[Record], bool] = None) -> Generator[Record, None, None]:
-        for file_name in self.list_files():
-            if file_name.startswith(relation.name):
-                path = self._get_heap_file_path(relation.name, int(file_name.split('_')[1].split('.')[0]))
-                self._open_heap_file(path)
-                self.current_heap_file.seek(0)
-
-                while True:
-                    record_data = self.current_heap_file.read(relation.record_length())
-                    if not record_data:
-                        break
-                    record = self._deserialize_record(relation, record_data)
-                    if predicate is None or predicate(record):
-                        yield record
-
-    def _deserialize_record(self, relation: Relation, data: bytes) -> Record:
-        offset = 0
-        # Deserialize the record_id first
-        record_id = struct.unpack_from('i', data, offset)[0]
-        offset += INT_SIZE
-        values = []
-        for attr_name, attr_type in relation.schema:
-            if attr_type == 'string':
-                value = struct.unpack_from(f'{CHAR_SIZE}s', data, offset)[0].decode('utf-8').strip('\x00')
-                offset += CHAR_SIZE
-            elif attr_type == 'bool':
-                value = struct.unpack_from('?', data, offset)[0]
-                offset += BOOL_SIZE
-            elif attr_type == 'int':
-                value = struct.unpack_from('i', data, offset)[0]
-                offset += INT_SIZE
-            values.append(value)
-
-        return Record(relation.name, record_id, tuple(values))
+        return bytes(serialized)
+
+    @metrics.timed
+    def scan(self, relation: Relation, predicate: Callable[[Record], bool] = None,
+             key_filter: Tuple[str, object] = None, reuse_row: bool = False) -> Generator[Record, None, None]:
+        """Yields the relation's records that satisfy the predicate.
+
+        key_filter=(column_name, filter) drops records whose key fails
+        filter.may_contain(key) (e.g. a bloom.KeyFilter built from the other side of
+        a join). Only the key field is decoded for dropped records.
+
+        With reuse_row=True the scan yields the same Record object every time,
+        pointed at the next record, so callers must not keep rows between steps.
+        """
+        yield from self.cursor(relation).scan(predicate, key_filter, reuse_row)
+
+    def _key_matcher(self, relation: Relation, key_filter) -> Callable[[bytes], bool]:
+        """Returns a test of the serialized record's key against key_filter, or None."""
+        if key_filter is None:
+            return None
+        column_name, key_set = key_filter
+        read_key = relation.field_reader(relation.column_index(column_name))
+
+        def key_matches(data: bytes) -> bool:
+            key = read_key(data)
+            if key_set.may_contain(key):
+                return True
+            metrics.incr('records_filtered')
+            return False
+        return key_matches
+
+    def _deserialize_record(self, relation: Relation, data: bytes, record_id: int) -> Record:
+        return Record(relation, record_id, data=data)
 
     def list_files(self) -> List[str]:
-        if not os.path.exists(self.heap_dir):
-            os.makedirs(self.heap_dir)
+        os.makedirs(self.heap_dir, exist_ok=True)
         return [f for f in os.listdir(self.heap_dir) if f.endswith('.heap')]
 
-    def make_index(self, relation: Relation, column_name: str):
-        column_index = next(i for i, (name, _) in enumerate(relation.schema) if name == column_name)
-        index = BPlusTree()
-
-        file_path = os.path.join(self.heap_dir, f"{relation.name}.idx")
-        with open(file_path, 'wb') as index_file:
-            for record in self.scan(relation):
-                value = record.values[column_index]
-                index.insert(value, record.record_id)
-
-        with open(file_path, 'wb') as index_file:
-            self._serialize_bplustree(index, index_file)
-
-    def scan_index(self, relation: Relation, predicate: Callable[[Record], bool], scan_type: str, *args) -> Generator[Record, None, None]:
-        index_file_path = os.path.join(self.heap_dir, f"{relation.name}.idx")
-
-        if not os.path.exists(index_file_path):
-            raise ValueError(f"Index file for relation {relation.name} not found.")
-
-        # Deserialize the BPlusTree from the index file
-        with open(index_file_path, 'rb') as index_file:
-            index_tree = self._deserialize_bplustree(index_file)
+    def heap_pages(self, relation: Relation) -> List[int]:
+        """Indexes of the relation's heap files, in ascending order."""
+        pages = []
+        for file_name in self.list_files():
+            name, _, index = file_name[:-len('.heap')].rpartition('_')
+            if name == relation.name:
+                pages.append(int(index))
+        return sorted(pages)
+
+    def scan_page(self, relation: Relation, page_index: int, predicate: Callable[[Record], bool] = None,
+                  key_filter: Tuple[str, object] = None, reuse_row: bool = False) -> Generator[Record, None, None]:
+        """Scans a single heap file, so a relation's pages can be scanned concurrently."""
+        yield from self.cursor(relation).scan_page(page_index, predicate, key_filter, reuse_row)
+
+    def _catalog_path(self) -> str:
+        return os.path.join(self.heap_dir, 'catalog.json')
+
+    def _load_catalog(self) -> dict:
+        if self.catalog is None:
+            if os.path.exists(self._catalog_path()):
+                with open(self._catalog_path()) as catalog_file:
+                    self.catalog = json.load(catalog_file)
+            else:
+                self.catalog = {'indexes': {}}
+        return self.catalog
+
+    def _save_catalog(self):
+        os.makedirs(self.heap_dir, exist_ok=True)
+        temp_path = f"{self._catalog_path()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as catalog_file:
+            json.dump(self.catalog, catalog_file, indent=2)
+        os.replace(temp_path, self._catalog_path())
+
+    def indexes(self, relation: Relation) -> List[Tuple[str, PagedBPlusTree]]:
+        """The relation's indexes from the catalog, as (column name, tree) pairs."""
+        with self.catalog_lock:
+            indexes = []
+            for entry in self._load_catalog()['indexes'].get(relation.name, []):
+                key = (relation.name, entry['column'])
+                if key not in self.open_indexes:
+                    path = os.path.join(self.heap_dir, entry['file'])
+                    self.open_indexes[key] = PagedBPlusTree(path, buffer_size=entry['buffer_size'])
+                indexes.append((entry['column'], self.open_indexes[key]))
+            return indexes
+
+    def index(self, relation: Relation, column_name: str = None) -> PagedBPlusTree:
+        """The relation's index on column_name, or its first index if no column is given."""
+        for column, index in self.indexes(relation):
+            if column_name is None or column == column_name:
+                return index
+        raise ValueError(f"Index file for relation {relation.name} not found.")
+
+    @metrics.timed
+    def make_index(self, relation: Relation, column_name: str, memory_limit: int = DEFAULT_MEMORY_LIMIT,
+                   buffer_size: int = 0):
+        """Builds an index on the column and registers it in the catalog.
+
+        The tree is bulk loaded from external-sorted (key, record_id) entries.
+        From then on insert_record(s) and delete_record maintain it; buffer_size > 0
+        selects the write-optimized buffered mode (see PagedBPlusTree).
+        """
+        column_index = relation.column_index(column_name)
+        file_name = f"{relation.name}.{column_name}.idx"
+        file_path = os.path.join(self.heap_dir, file_name)
+
+        with self.insert_lock:
+            entries = ((record.values[column_index], record.record_id) for record in self.scan(relation))
+            # Write then rename, so concurrent index scans see either the old or the new index
+            temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+            PagedBPlusTree.create(temp_path, external_sort(entries, key=lambda entry: entry[0], memory_limit=memory_limit,
+                                                           codec=StructCodec('ii'))).close()
+            os.replace(temp_path, file_path)
+
+            with self.catalog_lock:
+                previous = self.open_indexes.pop((relation.name, column_name), None)
+                if previous is not None:
+                    previous.close()
+                indexes = self._load_catalog()['indexes'].setdefault(relation.name, [])
+                indexes[:] = [entry for entry in indexes if entry['column'] != column_name]
+                indexes.append({'column': column_name, 'file': file_name, 'buffer_size': buffer_size})
+                self._save_catalog()
+
+    def flush(self):
+        """Writes the buffered entries of every open index to disk."""
+        with self.catalog_lock:
+            for index in self.open_indexes.values():
+                index.flush()
+
+    def close(self):
+        with self.catalog_lock:
+            for index in self.open_indexes.values():
+                index.close()
+            self.open_indexes = {}
+        with self.insert_lock:
+            if self.current_heap_file:
+                self.current_heap_file.close()
+                self.current_heap_file = None
+
+    @metrics.timed
+    def scan_index(self, relation: Relation, predicate: Callable[[Record], bool], scan_type: str, *args,
+                   column: str = None, bitmap_heap: bool = False, key_order: bool = False,
+                   prefetch: int = 4) -> Generator[Record, None, None]:
+        """Yields the records found through the relation's index on `column` (default: its first index).
+
+        By default every match is fetched in key order, through a cursor that keeps the
+        last page pinned. With bitmap_heap=True the matching record ids are sorted by
+        (page, slot) and each heap page is read once, with up to `prefetch` page reads
+        in flight while earlier pages are decoded. Records then come out in page order,
+        unless key_order=True, which sorts them back into key order at the end.
+        """
+        index_tree = self.index(relation, column)
 
         if scan_type == "scan":
             records = index_tree.scan()
@@ -206,45 +683,58 @@ class DiskManager:
         else:
             raise ValueError(f"Unsupported scan type: {scan_type}")
 
-        # Now retrieve the actual records corresponding to the found record_ids
+        if bitmap_heap:
+            yield from self._bitmap_heap_scan(relation, predicate, records, key_order, prefetch)
+            return
+
+        # Now retrieve the actual records corresponding to the found record_ids;
+        # the cursor keeps the last page pinned, so neighbouring ids share a read
+        cursor = self.cursor(relation)
         for (val, record_id) in records:
-            record = self.get_record(relation, record_id)
+            record = cursor.fetch(record_id)
             if predicate is None or predicate(record):
                 yield record
-
-    def _serialize_bplustree(self, tree: BPlusTree, file):
-        def _recurse_serialize(node: BPlusTreeNode):
-            file.write(b'\x01' if node.is_leaf else b'\x00')
-            file.write(struct.pack('i', len(node.keys)))
-            for key, record_id in node.keys:
-                file.write(struct.pack('i', key))
-                file.write(struct.pack('i', record_id))
-            file.write(struct.pack('i', len(node.children)))
-            for child in node.children:
-                _recurse_serialize(child)
-
-        _recurse_serialize(tree.root)
-
-    def _deserialize_bplustree(self, file) -> BPlusTree:
-        def _recurse_deserialize() -> BPlusTreeNode:
-            is_leaf = struct.unpack('b', file.read(1))[0] == 1
-            num_keys = struct.unpack('i', file.read(4))[0]
-            keys = []
-            for _ in range(num_keys):
-                key = struct.unpack('i', file.read(4))[0]
-                record_id = struct.unpack('i', file.read(4))[0]
-                keys.append((key, record_id))
-
-            num_children = struct.unpack('i', file.read(4))[0]
-            children = []
-            for _ in range(num_children):
-                children.append(_recurse_deserialize())
-
-            node = BPlusTreeNode(is_leaf=is_leaf)
-            node.keys = keys
-            node.children = children
-            return node
-
-        tree = BPlusTree()
-        tree.root = _recurse_deserialize()
-        return tree
+        cursor.close()
+
+    def _read_page(self, relation: Relation, page_index: int) -> bytes:
+        path = self._get_heap_file_path(relation.name, page_index)
+        with self.latch(relation.name, page_index).shared(), open(path, 'rb') as heap_file:
+            data = heap_file.read()
+        metrics.record_read(len(data), pages=1)
+        return data
+
+    def _bitmap_heap_scan(self, relation: Relation, predicate: Callable[[Record], bool], entries,
+                          key_order: bool, prefetch: int) -> Generator[Record, None, None]:
+        # Group the (slot, key order position) of every match by heap page
+        slots = defaultdict(list)
+        for position, (_, record_id) in enumerate(entries):
+            page_index, slot = split_record_id(record_id)
+            slots[page_index].append((slot, position))
+        page_indexes = sorted(slots)
+        prefetch = max(prefetch, 1)
+        matches = []
+
+        with ThreadPoolExecutor(max_workers=prefetch) as pool:
+            pending = [pool.submit(self._read_page, relation, page_index) for page_index in page_indexes[:prefetch]]
+            for i, page_index in enumerate(page_indexes):
+                if i + prefetch < len(page_indexes):
+                    pending.append(pool.submit(self._read_page, relation, page_indexes[i + prefetch]))
+                page = Page(pending[i].result())
+                pending[i] = None  # drop the page once it is decoded
+
+                for slot, position in sorted(slots[page_index]):
+                    record_id = make_record_id(page_index, slot)
+                    record_data = page.get(slot)
+                    if record_data is None:
+                        raise ValueError(f"Record at ID {record_id} not found.")
+                    record = self._deserialize_record(relation, record_data, record_id)
+                    if predicate is None or predicate(record):
+                        if key_order:
+                            matches.append((position, record))
+                        else:
+                            yield record
+
+        if key_order:
+            matches.sort(key=lambda match: match[0])
+            for _, record in matches:
+                yield record
@@ -1,4 +1,8 @@
 from heapfile import Relation, DiskManager, Record
+from bloom import KeyFilter
+from extsort import external_sort, sort_relation
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 # Define the relations
@@ -21,80 +25,135 @@ def nested_loop_join(relation1, relation2, predicate):
                 yield (record1, record2)
 
 def join_employee_worksin_department():
-    for emp_record in disk_manager.scan(employee_relation):
-        for works_record in disk_manager.scan(works_in_relation):
-            if emp_record.values[0] == works_record.values[0]:
-                for dept_record in disk_manager.scan(department_relation):
-                    if works_record.values[1] == dept_record.values[0]:
-                        yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for emp_record in disk_manager.scan(employee_relation, reuse_row=True):
+        for works_record in disk_manager.scan(works_in_relation, reuse_row=True):
+            if emp_record[0] == works_record[0]:
+                for dept_record in disk_manager.scan(department_relation, reuse_row=True):
+                    if works_record[1] == dept_record[0]:
+                        yield (emp_record[0], emp_record[1], works_record[1])
 
 def join_employee_worksin_department_deptindex():
-    for emp_record in disk_manager.scan(employee_relation):
-        for works_record in disk_manager.scan(works_in_relation):
-            if emp_record.values[0] == works_record.values[0]:
-                for dept_record in disk_manager.scan_index(department_relation, lambda record: record.values[0] == works_record.values[1], "search", works_record.values[1]):
-                    yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for emp_record in disk_manager.scan(employee_relation, reuse_row=True):
+        for works_record in disk_manager.scan(works_in_relation, reuse_row=True):
+            if emp_record[0] == works_record[0]:
+                for dept_record in disk_manager.scan_index(department_relation, lambda record: record[0] == works_record[1], "search", works_record[1]):
+                    yield (emp_record[0], emp_record[1], works_record[1])
 
 def join_workin_employee_department():
-    for works_record in disk_manager.scan(works_in_relation):
-        for emp_record in disk_manager.scan(employee_relation):
-            if works_record.values[0] == emp_record.values[0]:
-                for dept_record in disk_manager.scan(department_relation):
-                    if works_record.values[1] == dept_record.values[0]:
-                        yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for works_record in disk_manager.scan(works_in_relation, reuse_row=True):
+        for emp_record in disk_manager.scan(employee_relation, reuse_row=True):
+            if works_record[0] == emp_record[0]:
+                for dept_record in disk_manager.scan(department_relation, reuse_row=True):
+                    if works_record[1] == dept_record[0]:
+                        yield (emp_record[0], emp_record[1], works_record[1])
 
 def join_workin_employee_department_empindex():
-    for works_record in disk_manager.scan(works_in_relation):
-        condition = lambda record: record.values[0] == works_record.values[0]
-        for emp_record in disk_manager.scan_index(employee_relation, condition, "search", works_record.values[0]):
-            for dept_record in disk_manager.scan(department_relation):
-                if works_record.values[1] == dept_record.values[0]:
-                    yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for works_record in disk_manager.scan(works_in_relation, reuse_row=True):
+        condition = lambda record: record[0] == works_record[0]
+        for emp_record in disk_manager.scan_index(employee_relation, condition, "search", works_record[0]):
+            for dept_record in disk_manager.scan(department_relation, reuse_row=True):
+                if works_record[1] == dept_record[0]:
+                    yield (emp_record[0], emp_record[1], works_record[1])
 
 def join_workin_department_employee():
-    for works_record in disk_manager.scan(works_in_relation):
-        for dept_record in disk_manager.scan(department_relation):
-            if works_record.values[1] == dept_record.values[0]:
-                for emp_record in disk_manager.scan(employee_relation):
-                    if works_record.values[0] == emp_record.values[0]:
-                        yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for works_record in disk_manager.scan(works_in_relation, reuse_row=True):
+        for dept_record in disk_manager.scan(department_relation, reuse_row=True):
+            if works_record[1] == dept_record[0]:
+                for emp_record in disk_manager.scan(employee_relation, reuse_row=True):
+                    if works_record[0] == emp_record[0]:
+                        yield (emp_record[0], emp_record[1], works_record[1])
 
 def join_workin_department_employee_empindex():
-    for works_record in disk_manager.scan(works_in_relation):
-        for dept_record in disk_manager.scan(department_relation):
-            if works_record.values[1] == dept_record.values[0]:
-                for emp_record in disk_manager.scan_index(employee_relation, lambda record: record.values[0] == works_record.values[0], "search", works_record.values[0]):
-                    yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for works_record in disk_manager.scan(works_in_relation, reuse_row=True):
+        for dept_record in disk_manager.scan(department_relation, reuse_row=True):
+            if works_record[1] == dept_record[0]:
+                for emp_record in disk_manager.scan_index(employee_relation, lambda record: record[0] == works_record[0], "search", works_record[0]):
+                    yield (emp_record[0], emp_record[1], works_record[1])
 
 def join_workin_department_employee_deptindex_empindex():
-    for works_record in disk_manager.scan(works_in_relation):
-        for dept_record in disk_manager.scan_index(department_relation, lambda record: record.values[0] == works_record.values[1], "search", works_record.values[1]):
-            for emp_record in disk_manager.scan_index(employee_relation, lambda record: record.values[0] == works_record.values[0], "search", works_record.values[0]):
-                yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for works_record in disk_manager.scan(works_in_relation, reuse_row=True):
+        for dept_record in disk_manager.scan_index(department_relation, lambda record: record[0] == works_record[1], "search", works_record[1]):
+            for emp_record in disk_manager.scan_index(employee_relation, lambda record: record[0] == works_record[0], "search", works_record[0]):
+                yield (emp_record[0], emp_record[1], works_record[1])
 
 def join_department_workin_employee():
-    for dept_record in disk_manager.scan(department_relation):
-        for works_record in disk_manager.scan(works_in_relation):
-            if dept_record.values[0] == works_record.values[1]:
-                for emp_record in disk_manager.scan(employee_relation):
-                    if emp_record.values[0] == works_record.values[0]:
-                        yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for dept_record in disk_manager.scan(department_relation, reuse_row=True):
+        for works_record in disk_manager.scan(works_in_relation, reuse_row=True):
+            if dept_record[0] == works_record[1]:
+                for emp_record in disk_manager.scan(employee_relation, reuse_row=True):
+                    if emp_record[0] == works_record[0]:
+                        yield (emp_record[0], emp_record[1], works_record[1])
 
 def join_department_workin_employee_workindex():
-    for dept_record in disk_manager.scan(department_relation):
-        condition = lambda record: record.values[1] == dept_record.values[0]
-        for works_record in disk_manager.scan_index(works_in_relation, condition, "search", dept_record.values[0]):
-            if dept_record.values[0] == works_record.values[1]:
-                for emp_record in disk_manager.scan(employee_relation):
-                    if emp_record.values[0] == works_record.values[0]:
-                        yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for dept_record in disk_manager.scan(department_relation, reuse_row=True):
+        condition = lambda record: record[1] == dept_record[0]
+        for works_record in disk_manager.scan_index(works_in_relation, condition, "search", dept_record[0]):
+            if dept_record[0] == works_record[1]:
+                for emp_record in disk_manager.scan(employee_relation, reuse_row=True):
+                    if emp_record[0] == works_record[0]:
+                        yield (emp_record[0], emp_record[1], works_record[1])
 
 def join_department_workin_employee_workindex_empindex():
-    for dept_record in disk_manager.scan(department_relation):
-        condition = lambda record: record.values[1] == dept_record.values[0]
-        for works_record in disk_manager.scan_index(works_in_relation, condition, "search", dept_record.values[0]):
-            for emp_record in disk_manager.scan_index(employee_relation, lambda record: record.values[0] == works_record.values[0], "search", works_record.values[0]):
-                yield (emp_record.values[0], emp_record.values[1], works_record.values[1])
+    for dept_record in disk_manager.scan(department_relation, reuse_row=True):
+        condition = lambda record: record[1] == dept_record[0]
+        for works_record in disk_manager.scan_index(works_in_relation, condition, "search", dept_record[0]):
+            for emp_record in disk_manager.scan_index(employee_relation, lambda record: record[0] == works_record[0], "search", works_record[0]):
+                yield (emp_record[0], emp_record[1], works_record[1])
+
+# Sideways information passing: the key filter built while scanning one side is
+# pushed into the scan of the next relation, so non-matching rows are dropped
+# before they are decoded or probed
+def join_department_workin_employee_bloom(dept_predicate=None):
+    departments = {dept_record[0] for dept_record in disk_manager.scan(department_relation, dept_predicate)}
+    works_by_emp = defaultdict(list)
+    for works_record in disk_manager.scan(works_in_relation, key_filter=('dept_no', KeyFilter.build(departments))):
+        if works_record[1] in departments:
+            works_by_emp[works_record[0]].append(works_record)
+    for emp_record in disk_manager.scan(employee_relation, key_filter=('emp_id', KeyFilter.build(works_by_emp))):
+        for works_record in works_by_emp.get(emp_record[0], ()):
+            yield (emp_record[0], emp_record[1], works_record[1])
+
+def join_department_workin_employee_selective():
+    for dept_record in disk_manager.scan(department_relation, lambda record: 1 <= record[0] <= 3):
+        for works_record in disk_manager.scan(works_in_relation, reuse_row=True):
+            if dept_record[0] == works_record[1]:
+                for emp_record in disk_manager.scan(employee_relation, reuse_row=True):
+                    if emp_record[0] == works_record[0]:
+                        yield (emp_record[0], emp_record[1], works_record[1])
+
+def join_department_workin_employee_selective_bloom():
+    return join_department_workin_employee_bloom(lambda record: 1 <= record[0] <= 3)
+
+def merge_join(left, left_key, right, right_key):
+    """Joins two inputs sorted on their keys, yielding matching (left, right) pairs."""
+    right = iter(right)
+    right_row = next(right, None)
+    group_key, group = None, []
+    for left_row in left:
+        key = left_key(left_row)
+        if group and key == group_key:
+            for right_match in group:
+                yield (left_row, right_match)
+            continue
+        # collect the next group of equal right keys at or after this left key
+        while right_row is not None and right_key(right_row) < key:
+            right_row = next(right, None)
+        group_key, group = key, []
+        while right_row is not None and right_key(right_row) == key:
+            group.append(right_row)
+            right_row = next(right, None)
+        for right_match in group:
+            yield (left_row, right_match)
+
+def join_workin_employee_department_merge():
+    works_by_emp = sort_relation(disk_manager, works_in_relation, ['emp_id'])
+    employees = sort_relation(disk_manager, employee_relation, ['emp_id'])
+    works_employees = merge_join(works_by_emp, lambda record: record[0], employees, lambda record: record[0])
+    rows = ((emp_record[0], emp_record[1], works_record[1]) for works_record, emp_record in works_employees)
+    departments = sort_relation(disk_manager, department_relation, ['dept_no'])
+    for row, dept_record in merge_join(external_sort(rows, key=lambda row: row[2]), lambda row: row[2],
+                                       departments, lambda record: record[0]):
+        yield row
 
 # Benchmark join performance
 def benchmark_join(join_func, join_name):
@@ -113,6 +172,14 @@ def benchmark_join_formatted(join_func, join_name, trials):
     res = total_time / trials
     print(f"{join_name:<60}: {res:.2f} seconds with {len(records)} records")
 
+def benchmark_concurrent(join_funcs, workers):
+    # every query scans through its own cursors, so one DiskManager serves them all
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        counts = list(pool.map(lambda join_func: len(list(join_func())), join_funcs))
+    end_time = time.time()
+    print(f"{len(join_funcs)} joins on {workers} threads: {end_time - start_time:.2f} seconds with {sum(counts)} records")
+
 
 join_functions = [
     (join_employee_worksin_department, "Employee, WorksIn, Department"),
@@ -125,7 +192,13 @@ join_functions = [
     (join_department_workin_employee, "Department, WorksIn, Employee"),
     (join_department_workin_employee_workindex, "Department, WorksIn, Employee (Indexed)"),
     (join_department_workin_employee_workindex_empindex, "Department, WorksIn, Employee (WorksIn, Employee Index)"),
+    (join_department_workin_employee_bloom, "Department, WorksIn, Employee (Bloom Filters)"),
+    (join_workin_employee_department_merge, "WorksIn, Employee, Department (Sort-Merge)"),
+    (join_department_workin_employee_selective, "Department 1-3, WorksIn, Employee"),
+    (join_department_workin_employee_selective_bloom, "Department 1-3, WorksIn, Employee (Bloom Filters)"),
 ]
 
 for join_function, join_name in join_functions:
     benchmark_join_formatted(join_function, join_name, 10)
+
+benchmark_concurrent([join_function for join_function, _ in join_functions], 4)
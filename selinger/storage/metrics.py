@@ -0,0 +1,104 @@
+"""Counters and timers for the heap file, index and join code paths.
+
+Heap and index code counts pages, records and node visits with incr();
+example.py wraps each query in `with collect(name):` and prints the report.
+Outside a collect() block a counter costs one global check. @timed wraps
+functions only when METRICS=1 is set at import time.
+"""
+import os
+import time
+import functools
+import inspect
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Optional
+
+ENABLED = os.environ.get('METRICS', '0') not in ('', '0')
+
+
+class Stats:
+    """Counters and timers collected while running one query."""
+
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)  # seconds spent in each timed function
+        self.calls = defaultdict(int)
+        self.elapsed = 0.0
+
+    def add_time(self, name: str, duration: float) -> None:
+        self.timers[name] += duration
+        self.calls[name] += 1
+
+    def report(self) -> str:
+        lines = [f"{self.name or 'query'}: {self.elapsed:.4f}s"]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"  {name:<28} {value}")
+        for name, seconds in sorted(self.timers.items(), key=lambda item: -item[1]):
+            lines.append(f"  {name:<28} {seconds:.4f}s in {self.calls[name]} calls")
+        return '\n'.join(lines)
+
+
+_active: Optional[Stats] = None
+
+
+def incr(name: str, n: int = 1) -> None:
+    if _active is not None:
+        _active.counters[name] += n
+
+
+def record_read(nbytes: int, pages: int = 0) -> None:
+    """Counts one file open and read of nbytes (and the pages it covered)."""
+    if _active is not None:
+        _active.counters['file_opens'] += 1
+        _active.counters['bytes_read'] += nbytes
+        if pages:
+            _active.counters['pages_read'] += pages
+
+
+@contextmanager
+def collect(name: Optional[str] = None):
+    """Collects counters and timers for everything run inside the block."""
+    global _active
+    stats, previous = Stats(name), _active
+    _active = stats
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.elapsed = time.perf_counter() - start
+        _active = previous
+
+
+def timed(fn):
+    """Records the time spent in fn (and for generators, in producing each item)."""
+    if not ENABLED:
+        return fn
+    name = fn.__qualname__
+
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generator_wrapper(*args, **kwargs):
+            generator = fn(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    if _active is not None:
+                        _active.add_time(name, time.perf_counter() - start)
+                yield item
+        return generator_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _active.add_time(name, time.perf_counter() - start)
+    return wrapper
@@ -1,20 +1,127 @@
 import os
 import random
 import struct
-import pickle
-from line_profiler import profile
+import numpy as np
+from collections import OrderedDict
+from bitmap import BitmapIndex
+from compression import decode, encode
+import codegen
+import metrics
+
+class StringDictionary:
+    """Index over a string field: a sorted dictionary of its distinct values.
+
+    A value's code is its position in the sorted dictionary, so every prefix maps
+    to a contiguous range of codes. The posting list holds the tuple ids grouped
+    by code, so the ids for a code range are a single slice.
+    """
+    def __init__(self, values):
+        self.values, codes = np.unique(np.asarray(values), return_inverse=True)
+        self.codes = codes.astype(np.uint32)  # code of every tuple, indexed by tuple id
+        self.postings = np.argsort(self.codes, kind='stable').astype(np.uint32)
+        self.offsets = np.searchsorted(self.codes[self.postings], np.arange(len(self.values) + 1))
+
+    def key(self, value):
+        # converts a query string to the dictionary's dtype
+        return np.array(value, dtype=self.values.dtype.kind)
+
+    def lookup(self, value):
+        # binary search over the dictionary; -1 if the value does not occur
+        value = self.key(value)
+        code = int(np.searchsorted(self.values, value))
+        if code < len(self.values) and self.values[code] == value:
+            return code
+        return -1
+
+    def prefix_range(self, prefix):
+        # [low, high) codes of all values starting with prefix
+        if not prefix:
+            return 0, len(self.values)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return int(np.searchsorted(self.values, self.key(prefix))), int(np.searchsorted(self.values, self.key(upper)))
+
+    def tuple_ids(self, low, high):
+        # tuple ids of codes in [low, high), in tuple id order
+        return np.sort(self.postings[self.offsets[low]:self.offsets[high]])
+
+# Type of every field; name is a variable-length string ('U' arrays are as wide as their longest value)
+FIELD_TYPES = {'name': 'U', 'age': '<i4', 'salary': '<i4'}
+STRING_COUNT_FORMAT = '<I'  # string pages start with their number of values, then offsets into a utf-8 blob
+
+def select_source(schema, page_size, ranges, projection):
+    # Source of a compiled select over column pages: only the columns the query uses are
+    # loaded, and the predicate runs on their values with the constants written in
+    def column(field):
+        return codegen.variable(field) + '_column'
+
+    extra = [field for field in projection or () if field not in ranges]
+    lines = ["def pipeline(storage):",
+             "    matches = []",
+             "    append = matches.append",
+             "    for page_id in range(storage.num_pages()):",
+             f"        base = page_id * {page_size}"]
+    for field in list(ranges) + extra or [schema[0]]:
+        lines.append(f"        {column(field)} = storage.load_column({field!r}, page_id).tolist()")
+    if not ranges:
+        lines.append(f"        for row in range(len({column((extra or schema)[0])})):")
+    elif len(ranges) == 1:
+        field = next(iter(ranges))
+        lines.append(f"        for row, {codegen.variable(field)} in enumerate({column(field)}):")
+    else:
+        names = ', '.join(codegen.variable(field) for field in ranges)
+        columns = ', '.join(column(field) for field in ranges)
+        lines.append(f"        for row, ({names}) in enumerate(zip({columns})):")
+    lines.append(f"            if {codegen.predicate_source(ranges)}:")
+    for field in extra:
+        lines.append(f"                {codegen.variable(field)} = {column(field)}[row]")
+    lines.append(f"                append({codegen.result_source(projection, 'base + row')})")
+    lines.append("    return matches")
+    return lines, {}
+
+class PageCache:
+    """LRU cache of column pages that keeps at most memory_limit bytes resident."""
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.pages = OrderedDict()  # (field, page_id) -> numpy array
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        if key in self.pages:
+            self.hits += 1
+            metrics.incr('cache_hits')
+            self.pages.move_to_end(key)
+            return self.pages[key]
+        self.misses += 1
+        metrics.incr('cache_misses')
+        page = load()
+        self.pages[key] = page
+        self.size += page.nbytes
+        # evict least recently used pages, but never the one just loaded
+        while self.size > self.memory_limit and len(self.pages) > 1:
+            _, evicted = self.pages.popitem(last=False)
+            self.size -= evicted.nbytes
+        return page
+
+    def invalidate(self, key):
+        if key in self.pages:
+            self.size -= self.pages.pop(key).nbytes
 
 class TupleStorageSystem:
-    def __init__(self, schema, page_size=10000):
+    def __init__(self, schema, page_size=10000, memory_limit=64 * 1024 * 1024):
         self.schema = schema  # Schema is a list of field names and types
         self.page_size = page_size  # Number of tuples per page
         self.pages_dir = 'pages'  # Directory to store pages
         os.makedirs(self.pages_dir, exist_ok=True)
 
-        # Initialize field values storage
-        self.field_values = {field: [] for field in schema}
-        self.tuple_ids = []
+        # Column pages are read lazily through the cache; only the page being filled stays in memory.
+        # Tuple ids are implicit: tuple i is row i % page_size of page i // page_size.
+        self.cache = PageCache(memory_limit)
+        self.buffer = {field: [] for field in schema}
         self.current_tuple_count = 0
+        self.string_indexes = {}  # field name -> StringDictionary
+        self.bitmap_indexes = {}  # field name -> BitmapIndex
 
     def generate_random_tuple(self):
         tuple_data = []
@@ -28,100 +135,207 @@ class TupleStorageSystem:
         return tuple_data
 
     def add_tuple(self, tuple_data):
-        tuple_id = self.current_tuple_count
-        self.tuple_ids.append(tuple_id)
         for field, value in zip(self.schema, tuple_data):
-            self.field_values[field].append(value)
+            self.buffer[field].append(value)
         self.current_tuple_count += 1
 
         # If page is full, write to disk
         if self.current_tuple_count % self.page_size == 0:
             self.write_page()
 
+    def page_path(self, field, page_id):
+        return os.path.join(self.pages_dir, f'{field}_{page_id}.col')
+
     def write_page(self):
-        page_id = len(os.listdir(self.pages_dir))
-        # Serialize the current tuple ids
-        with open(os.path.join(self.pages_dir, f'page_{page_id}.pkl'), 'wb') as f:
-            pickle.dump(self.tuple_ids[-self.page_size:], f)
+        # The buffer always holds the last page; it is kept until the page is full
+        page_id = (self.current_tuple_count - 1) // self.page_size
+        for field in self.schema:
+            self.write_column(field, page_id, np.array(self.buffer[field], dtype=FIELD_TYPES[field]))
+            self.cache.invalidate((field, page_id))
+        if self.current_tuple_count % self.page_size == 0:
+            self.buffer = {field: [] for field in self.schema}
+
+    def write_column(self, field, page_id, column):
+        # Integer columns are stored compressed; string columns as offsets into their utf-8 bytes
+        with open(self.page_path(field, page_id), 'wb') as f:
+            if column.dtype.kind == 'i':
+                f.write(encode(column.view('<u4')))
+                return
+            values = [value.encode('utf-8') for value in column.tolist()]
+            offsets = np.zeros(len(values) + 1, dtype='<u4')
+            np.cumsum([len(value) for value in values], out=offsets[1:])
+            f.write(struct.pack(STRING_COUNT_FORMAT, len(values)))
+            f.write(offsets.tobytes())
+            f.write(b''.join(values))
+
+    def read_column(self, field, page_id):
+        with open(self.page_path(field, page_id), 'rb') as f:
+            data = f.read()
+        metrics.record_read(len(data), pages=1)
+        if np.dtype(FIELD_TYPES[field]).kind == 'i':
+            return decode(data).view(FIELD_TYPES[field])
+        count, = struct.unpack_from(STRING_COUNT_FORMAT, data)
+        start = struct.calcsize(STRING_COUNT_FORMAT)
+        offsets = np.frombuffer(data, dtype='<u4', count=count + 1, offset=start)
+        blob = data[start + offsets.nbytes:]
+        bounds = offsets.tolist()
+        return np.array([blob[low:high].decode('utf-8') for low, high in zip(bounds, bounds[1:])], dtype='U')
 
     def create_tuples(self, n):
         for _ in range(n):
             random_tuple = self.generate_random_tuple()
             self.add_tuple(random_tuple)
         # Write any remaining tuples if the last page isn't full
-        if len(self.tuple_ids) % self.page_size != 0:
+        if self.current_tuple_count % self.page_size != 0:
             self.write_page()
 
+    def num_pages(self):
+        return -(-self.current_tuple_count // self.page_size)
+
+    def load_column(self, field, page_id):
+        # Returns one column of a page, as a numpy array
+        if page_id == self.current_tuple_count // self.page_size:
+            return np.array(self.buffer[field], dtype=FIELD_TYPES[field])
+        return self.cache.get((field, page_id),
+                              lambda: self.read_column(field, page_id))
+
     def load_page(self, page_id):
-        with open(os.path.join(self.pages_dir, f'page_{page_id}.pkl'), 'rb') as f:
-            tuple_ids = pickle.load(f)
-        return tuple_ids
+        return {field: self.load_column(field, page_id) for field in self.schema}
+
+    def page_tuples(self, page_id):
+        # Decodes a page into (tuple id, tuple data) pairs
+        columns = [self.load_column(field, page_id).tolist() for field in self.schema]
+        return enumerate(zip(*columns), start=page_id * self.page_size)
 
     def select(self, predicate):
         satisfying_ids = []
-        for tuple_id in self.tuple_ids:
-            tuple_data = self.get_tuple_data(tuple_id)
-            if predicate(tuple_data):
-                satisfying_ids.append(tuple_id)
+        for page_id in range(self.num_pages()):
+            for tuple_id, tuple_data in self.page_tuples(page_id):
+                if predicate(tuple_data):
+                    satisfying_ids.append(tuple_id)
         return satisfying_ids
 
+    def select_where(self, ranges, projection=None):
+        # Compiled select: ranges maps field name -> (low, high), either bound may be None.
+        # Returns the matching tuple ids, or tuples of the projected fields.
+        # The pipeline is compiled once per query shape and reused by later calls
+        shape = codegen.query_shape(('columnar', tuple(self.schema), self.page_size), ranges, projection)
+        pipeline = codegen.compile_pipeline(shape, lambda: select_source(self.schema, self.page_size, ranges, projection))
+        return pipeline(self)
+
     def select_tid(self, predicate):
         satisfying_ids = []
-        for tuple_id in self.tuple_ids:
-            tuple_data = self.get_tuple_data(tuple_id)
-            if predicate(tuple_data):
-                satisfying_ids.append(tuple_id)
+        for page_id in range(self.num_pages()):
+            for tuple_id, tuple_data in self.page_tuples(page_id):
+                if predicate(tuple_data):
+                    satisfying_ids.append(tuple_id)
         return satisfying_ids
 
     def get_tuple_data(self, tuple_id):
-        return [self.field_values[field][tuple_id] for field in self.schema]
+        page_id, row = divmod(tuple_id, self.page_size)
+        values = [self.load_column(field, page_id)[row] for field in self.schema]
+        return [str(value) if isinstance(value, str) else int(value) for value in values]
+
+    def build_string_index(self, field_name):
+        # The last page may still be in the buffer, so pages are loaded like every other read
+        values = np.concatenate([self.load_column(field_name, page_id) for page_id in range(self.num_pages())])
+        self.string_indexes[field_name] = StringDictionary(values)
+
+    def build_bitmap_index(self, field_name, bin_width=1, encoding='equality'):
+        values = np.concatenate([self.load_column(field_name, page_id) for page_id in range(self.num_pages())])
+        tuple_ids = np.arange(self.current_tuple_count, dtype=np.uint32)
+        self.bitmap_indexes[field_name] = BitmapIndex.build(tuple_ids, values, bin_width, encoding)
+
+    def get_values(self, field_name, tuple_ids):
+        # Values of one field for ascending tuple ids, reading each page once
+        page_ids = tuple_ids // self.page_size
+        values = []
+        for page_id in np.unique(page_ids):
+            rows = page_ids == page_id
+            values.append(self.load_column(field_name, int(page_id))[tuple_ids[rows] % self.page_size])
+        # concatenating widens string pages to the longest value among them
+        return np.concatenate(values) if values else np.empty(0, dtype=FIELD_TYPES[field_name])
+
+    def select_bitmap(self, ranges):
+        # ranges maps field name -> (low, high), either bound may be None; returns the Bitmap of the conjunction
+        result = None
+        for field_name, (low, high) in ranges.items():
+            values_for = lambda tuple_ids, field_name=field_name: self.get_values(field_name, tuple_ids)
+            matches = self.bitmap_indexes[field_name].range(low, high, values_for)
+            result = matches if result is None else result & matches
+        return result
+
+    def select_string_equal(self, field_name, value):
+        index = self.string_indexes[field_name]
+        code = index.lookup(value)
+        if code == -1:
+            return []
+        return index.tuple_ids(code, code + 1).tolist()
+
+    def select_string_prefix(self, field_name, prefix):
+        index = self.string_indexes[field_name]
+        return index.tuple_ids(*index.prefix_range(prefix)).tolist()
 
     def find_field_id(self, field_name, value):
         if field_name not in self.schema:
             return -1  # Not found
 
+        # The string index covers the tuples that existed when it was built; later ones are scanned
+        unindexed = 0
+        if field_name in self.string_indexes:
+            index = self.string_indexes[field_name]
+            code = index.lookup(value)
+            if code != -1:
+                return int(index.tuple_ids(code, code + 1)[0])
+            unindexed = len(index.codes)
+
         field_index = self.schema.index(field_name)
-        for i, val in enumerate(self.field_values[field_name]):
-            if val == value:
-                return i  # Return the tuple ID of the found value
+        for page_id in range(unindexed // self.page_size, self.num_pages()):
+            for tuple_id, tuple_data in self.page_tuples(page_id):
+                if tuple_id >= unindexed and tuple_data[field_index] == value:
+                    return tuple_id  # Return the tuple ID of the found value
         return -1  # Not found
 
-@profile
+@metrics.timed
 def number_threshold_one_field(storage):
     # Example predicate: Select tuples where age is over 30
-    result = storage.select(lambda tup: tup[1] > 30)
+    result = storage.select_where({'age': (31, None)})
     print("Selected Tuple IDs:", len(result))
 
 
-@profile
+@metrics.timed
 def number_threshold_two_fields(storage):
     # Example predicate: Select tuples where salary is over 80000 and age is over 40
-    result = storage.select(lambda tup: tup[2] > 80000 and tup[1] > 40)
+    result = storage.select_bitmap({'salary': (80001, None), 'age': (41, None)})
     print("Selected Tuple IDs:", len(result))
 
 
-@profile
+@metrics.timed
 def string_exact_match(storage):
     # Example predicate: Select tuples where name is 'JOHN'
     field_id = storage.find_field_id('name', 'JOHN')
     print("Field ID for name 'JOHN':", field_id)
 
-    result = storage.select_tid(lambda tup: tup[0] == field_id)
+    result = storage.select_string_equal('name', 'JOHN')
     print("Selected Tuple IDs:", len(result))
 
 
-@profile
+@metrics.timed
 def string_prefix_match(storage):
     # Example predicate: Select tuples where name starts with 'J'
-    result = storage.select(lambda tup: tup[0].startswith('J'))
+    result = storage.select_string_prefix('name', 'J')
     print("Selected Tuple IDs:", len(result))
 
 # Example usage
-schema = ['name', 'age', 'salary']
-storage = TupleStorageSystem(schema)
-storage.create_tuples(10_000_000)
-
-number_threshold_one_field(storage)
-number_threshold_two_fields(storage)
-string_exact_match(storage)
-string_prefix_match(storage)
+if __name__ == '__main__':
+    schema = ['name', 'age', 'salary']
+    storage = TupleStorageSystem(schema)
+    storage.create_tuples(10_000_000)
+    storage.build_string_index('name')
+    storage.build_bitmap_index('age')
+    storage.build_bitmap_index('salary', bin_width=1000, encoding='range')
+
+    for query in [number_threshold_one_field, number_threshold_two_fields, string_exact_match, string_prefix_match]:
+        with metrics.collect(query.__name__) as stats:
+            query(storage)
+        print(stats.report())
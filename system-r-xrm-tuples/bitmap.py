@@ -0,0 +1,220 @@
+import pickle
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+# Row ids are split into chunks of 64K ids (the low 16 bits index into the chunk).
+# Sparse chunks keep a sorted uint16 array of ids, dense chunks a 64K-bit bitset.
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+ARRAY_LIMIT = 4096  # an array container this large takes as much space as a bitset
+
+
+def _popcount(bitset: np.ndarray) -> int:
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(bitset).sum())
+    return int(np.unpackbits(bitset.view(np.uint8)).sum())
+
+
+def _is_bitset(container: np.ndarray) -> bool:
+    return container.dtype == np.uint64
+
+
+def _to_bitset(container: np.ndarray) -> np.ndarray:
+    if _is_bitset(container):
+        return container
+    bits = np.zeros(CHUNK_SIZE, dtype=bool)
+    bits[container] = True
+    return np.packbits(bits, bitorder='little').view(np.uint64)
+
+
+def _to_array(container: np.ndarray) -> np.ndarray:
+    if not _is_bitset(container):
+        return container
+    return np.flatnonzero(np.unpackbits(container.view(np.uint8), bitorder='little')).astype(np.uint16)
+
+
+def _contains(bitset: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    ids = ids.astype(np.uint64)
+    return ((bitset[ids >> np.uint64(6)] >> (ids & np.uint64(63))) & np.uint64(1)).astype(bool)
+
+
+def _cardinality(container: np.ndarray) -> int:
+    return _popcount(container) if _is_bitset(container) else len(container)
+
+
+def _optimize(container: np.ndarray) -> Optional[np.ndarray]:
+    """Picks the smaller representation for a container, or None if it is empty."""
+    cardinality = _cardinality(container)
+    if cardinality == 0:
+        return None
+    if cardinality <= ARRAY_LIMIT:
+        return _to_array(container)
+    return _to_bitset(container)
+
+
+def _and(a: np.ndarray, b: np.ndarray) -> Optional[np.ndarray]:
+    if _is_bitset(a) and _is_bitset(b):
+        return _optimize(a & b)
+    if _is_bitset(a):
+        a, b = b, a
+    if _is_bitset(b):
+        return _optimize(a[_contains(b, a)])
+    return _optimize(np.intersect1d(a, b, assume_unique=True))
+
+
+def _or(a: np.ndarray, b: np.ndarray) -> Optional[np.ndarray]:
+    if not _is_bitset(a) and not _is_bitset(b):
+        return _optimize(np.union1d(a, b))
+    return _to_bitset(a) | _to_bitset(b)
+
+
+def _andnot(a: np.ndarray, b: np.ndarray) -> Optional[np.ndarray]:
+    if _is_bitset(a):
+        return _optimize(a & ~_to_bitset(b))
+    if _is_bitset(b):
+        return _optimize(a[~_contains(b, a)])
+    return _optimize(np.setdiff1d(a, b, assume_unique=True))
+
+
+class Bitmap:
+    """Compressed set of row ids (roaring-style)."""
+
+    def __init__(self, containers: Dict[int, np.ndarray] = None):
+        self.containers = containers or {}  # chunk number -> container
+
+    @classmethod
+    def from_ids(cls, ids: np.ndarray) -> 'Bitmap':
+        """Builds a bitmap from sorted, unique row ids."""
+        ids = np.asarray(ids, dtype=np.uint32)
+        chunks, starts = np.unique(ids >> CHUNK_BITS, return_index=True)
+        bounds = list(starts[1:]) + [len(ids)]
+        containers = {}
+        for chunk, start, end in zip(chunks.tolist(), starts, bounds):
+            containers[chunk] = _optimize((ids[start:end] & (CHUNK_SIZE - 1)).astype(np.uint16))
+        return cls(containers)
+
+    def _combine(self, other: 'Bitmap', op: Callable, chunks) -> 'Bitmap':
+        containers = {}
+        for chunk in sorted(chunks):
+            if chunk not in other.containers:
+                result = self.containers[chunk] if op is not _and else None
+            elif chunk not in self.containers:
+                result = other.containers[chunk] if op is _or else None
+            else:
+                result = op(self.containers[chunk], other.containers[chunk])
+            if result is not None:
+                containers[chunk] = result
+        return Bitmap(containers)
+
+    def __and__(self, other: 'Bitmap') -> 'Bitmap':
+        return self._combine(other, _and, self.containers.keys() & other.containers.keys())
+
+    def __or__(self, other: 'Bitmap') -> 'Bitmap':
+        return self._combine(other, _or, self.containers.keys() | other.containers.keys())
+
+    def __sub__(self, other: 'Bitmap') -> 'Bitmap':
+        return self._combine(other, _andnot, self.containers.keys())
+
+    def __len__(self) -> int:
+        return sum(_cardinality(container) for container in self.containers.values())
+
+    def to_ids(self) -> np.ndarray:
+        """Returns the row ids in the bitmap, in ascending order."""
+        ids = [np.uint32(chunk << CHUNK_BITS) | _to_array(self.containers[chunk]).astype(np.uint32)
+               for chunk in sorted(self.containers)]
+        return np.concatenate(ids) if ids else np.zeros(0, dtype=np.uint32)
+
+
+class BitmapIndex:
+    """Bitmap index over an integer column.
+
+    Values are grouped into bins of bin_width values. 'equality' encoding keeps
+    one bitmap per bin, which suits low-cardinality fields. 'range' encoding keeps,
+    for every bin b, the rows whose bin is <= b, so any range of bins takes at most
+    two bitmaps; with wide bins it suits wide-domain fields.
+    """
+
+    def __init__(self, bitmaps: List[Bitmap], low: int, bin_width: int, encoding: str):
+        self.bitmaps = bitmaps
+        self.low = low
+        self.bin_width = bin_width
+        self.encoding = encoding
+
+    @classmethod
+    def build(cls, row_ids: np.ndarray, values: np.ndarray, bin_width: int = 1,
+              encoding: str = 'equality') -> 'BitmapIndex':
+        """Builds an index from ascending row ids and their values."""
+        if encoding not in ('equality', 'range'):
+            raise ValueError(f"Unsupported bitmap encoding: {encoding}")
+        values = np.asarray(values, dtype=np.int64)
+        low = int(values.min()) if len(values) else 0
+        bins = (values - low) // bin_width
+        nbins = int(bins.max()) + 1 if len(values) else 0
+
+        # stable sort keeps the row ids of every bin ascending
+        order = np.argsort(bins, kind='stable')
+        bounds = np.searchsorted(bins[order], np.arange(nbins + 1))
+        sorted_ids = np.asarray(row_ids, dtype=np.uint32)[order]
+        bitmaps = [Bitmap.from_ids(sorted_ids[bounds[b]:bounds[b + 1]]) for b in range(nbins)]
+        if encoding == 'range':
+            for b in range(1, nbins):
+                bitmaps[b] = bitmaps[b - 1] | bitmaps[b]
+        return cls(bitmaps, low, bin_width, encoding)
+
+    def _bins(self, first: int, last: int) -> Bitmap:
+        """Rows whose bin lies in [first, last]."""
+        if self.encoding == 'range':
+            below = self.bitmaps[first - 1] if first > 0 else Bitmap()
+            return self.bitmaps[last] - below
+        result = Bitmap()
+        for bitmap in self.bitmaps[first:last + 1]:
+            result = result | bitmap
+        return result
+
+    def range(self, low: Optional[int] = None, high: Optional[int] = None,
+              values_for: Callable[[np.ndarray], np.ndarray] = None) -> Bitmap:
+        """Rows with low <= value <= high; None leaves that side unbounded.
+
+        Bins only partly covered by the range hold candidates that are checked
+        against their actual values with values_for(row_ids) -> values.
+        """
+        high_value = self.low + len(self.bitmaps) * self.bin_width - 1
+        low = self.low if low is None else max(low, self.low)
+        high = high_value if high is None else min(high, high_value)
+        if low > high:
+            return Bitmap()
+        first = (low - self.low) // self.bin_width
+        last = (high - self.low) // self.bin_width
+        result = self._bins(first, last)
+        if self.bin_width == 1:
+            return result
+
+        edges = set()
+        if low > self.low + first * self.bin_width:
+            edges.add(first)
+        if high < self.low + (last + 1) * self.bin_width - 1:
+            edges.add(last)
+        if not edges:
+            return result
+        if values_for is None:
+            raise ValueError("values_for is required for ranges that do not align with bin boundaries")
+        candidates = Bitmap()
+        for edge in edges:
+            candidates = candidates | self._bins(edge, edge)
+        ids = candidates.to_ids()
+        values = values_for(ids)
+        matching = Bitmap.from_ids(ids[(values >= low) & (values <= high)])
+        return (result - candidates) | matching
+
+    def equal(self, value: int, values_for: Callable[[np.ndarray], np.ndarray] = None) -> Bitmap:
+        return self.range(value, value, values_for)
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: str) -> 'BitmapIndex':
+        with open(path, 'rb') as f:
+            return pickle.load(f)
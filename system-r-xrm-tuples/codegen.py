@@ -0,0 +1,90 @@
+"""Compiles queries into specialized Python scan pipelines.
+
+A layout turns a query (the (low, high) ranges it filters on and the fields it
+projects) into the source of a single function, with field offsets, struct
+formats and the predicate's constants written into the code, so the per-tuple
+loop does no schema lookups or method calls. Compiled pipelines are cached by
+the shape of the query, so running the same query again reuses the function.
+"""
+import re
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import metrics
+
+CACHE_SIZE = 256  # compiled pipelines kept, least recently used are dropped first
+
+_pipelines = OrderedDict()  # query shape -> compiled pipeline
+
+
+def query_shape(layout: Hashable, ranges: Dict[str, Tuple], projection: Optional[Sequence[str]]) -> Tuple:
+    """Cache key of a query: everything that is compiled into its pipeline."""
+    return layout, tuple(ranges.items()), None if projection is None else tuple(projection)
+
+
+def variable(field_name: str) -> str:
+    """Name of the local variable holding a field's value in generated code."""
+    return 'f_' + re.sub(r'\W', '_', field_name)
+
+
+def predicate_source(ranges: Dict[str, Tuple], convert: Callable = None) -> str:
+    """A Python expression testing every (low, high) range of ranges; either bound may be None.
+
+    convert maps a bound to the literal the field's values compare against.
+    """
+    terms = []
+    for field_name, (low, high) in ranges.items():
+        name = variable(field_name)
+        if convert is not None:
+            low, high = (None if bound is None else convert(field_name, bound) for bound in (low, high))
+        if low is not None and low == high:
+            terms.append(f"{name} == {low!r}")
+        elif low is not None and high is not None:
+            terms.append(f"{low!r} <= {name} <= {high!r}")
+        elif low is not None:
+            terms.append(f"{name} >= {low!r}")
+        elif high is not None:
+            terms.append(f"{name} <= {high!r}")
+    return ' and '.join(terms) or 'True'
+
+
+def result_source(projection: Optional[Sequence[str]], tid: str) -> str:
+    """The expression a pipeline produces for a match: its TID, or its projected values."""
+    if projection is None:
+        return tid
+    names = [variable(field_name) for field_name in projection]
+    return '(' + ', '.join(names) + (',' if len(names) == 1 else '') + ')'
+
+
+def compile_pipeline(shape: Hashable, build: Callable[[], Tuple[List[str], dict]]) -> Callable:
+    """Returns the pipeline cached for the query shape, generating and compiling it on a miss.
+
+    build returns the source lines of a function named `pipeline` and the globals it uses.
+    The source of a compiled pipeline is kept in its `source` attribute.
+    """
+    pipeline = _pipelines.get(shape)
+    if pipeline is not None:
+        _pipelines.move_to_end(shape)
+        metrics.incr('pipeline_cache_hits')
+        return pipeline
+
+    lines, namespace = build()
+    source = '\n'.join(lines) + '\n'
+    namespace = {'incr': metrics.incr, 'record_read': metrics.record_read, **namespace}
+    exec(compile(source, f"<pipeline {shape!r}>", 'exec'), namespace)
+    pipeline = namespace['pipeline']
+    pipeline.source = source
+    metrics.incr('pipelines_compiled')
+
+    _pipelines[shape] = pipeline
+    if len(_pipelines) > CACHE_SIZE:
+        _pipelines.popitem(last=False)
+    return pipeline
+
+
+def read_file(path: str) -> bytes:
+    """Reads a whole page file for a pipeline."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    metrics.record_read(len(data), pages=1)
+    return data
@@ -0,0 +1,123 @@
+import struct
+from typing import Optional
+
+import numpy as np
+
+# Codecs for a page of unsigned 32-bit values
+RAW = 0       # values as-is
+BITPACK = 1   # values packed into just enough bits for the largest one
+FOR = 2       # frame of reference: value - base, bit-packed
+RLE = 3       # runs of equal values: run values as FOR, run lengths bit-packed
+
+# codec, count, base, width, number of runs, run length width
+HEADER_FORMAT = '<BIIBIB'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def pack_bits(values: np.ndarray, width: int) -> bytes:
+    """Packs each value into its low `width` bits."""
+    if width == 0:
+        return b''
+    bits = np.unpackbits(values.astype('<u4').view(np.uint8).reshape(-1, 4), axis=1, bitorder='little')
+    return np.packbits(bits[:, :width], bitorder='little').tobytes()
+
+
+def unpack_bits(data: bytes, count: int, width: int) -> np.ndarray:
+    if width == 0:
+        return np.zeros(count, dtype=np.uint32)
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=count * width, bitorder='little')
+    padded = np.zeros((count, 32), dtype=np.uint8)
+    padded[:, :width] = bits.reshape(count, width)
+    return np.packbits(padded, axis=1, bitorder='little').view('<u4').ravel().astype(np.uint32)
+
+
+def _width(value: int) -> int:
+    return int(value).bit_length()
+
+
+def _packed_size(count: int, width: int) -> int:
+    return (count * width + 7) // 8
+
+
+def choose_codec(values: np.ndarray) -> int:
+    """Picks the codec producing the smallest page from simple statistics."""
+    if len(values) == 0:
+        return RAW
+    low, high = int(values.min()), int(values.max())
+    runs = int(np.count_nonzero(values[1:] != values[:-1])) + 1
+    longest_run = len(values) if runs == 1 else int(np.diff(np.flatnonzero(
+        np.concatenate(([True], values[1:] != values[:-1], [True])))).max())
+    sizes = {
+        RAW: 4 * len(values),
+        BITPACK: _packed_size(len(values), _width(high)),
+        FOR: _packed_size(len(values), _width(high - low)),
+        RLE: _packed_size(runs, _width(high - low)) + _packed_size(runs, _width(longest_run)),
+    }
+    return min(sizes, key=sizes.get)
+
+
+def encode(values: np.ndarray, codec: Optional[int] = None) -> bytes:
+    """Encodes a page of values, choosing the codec if none is given."""
+    values = np.asarray(values, dtype=np.uint32)
+    if codec is None:
+        codec = choose_codec(values)
+    count = len(values)
+    base = int(values.min()) if count and codec in (FOR, RLE) else 0
+    if codec == RAW:
+        return struct.pack(HEADER_FORMAT, RAW, count, 0, 32, 0, 0) + values.astype('<u4').tobytes()
+    if codec in (BITPACK, FOR):
+        width = _width(int(values.max()) - base) if count else 0
+        header = struct.pack(HEADER_FORMAT, codec, count, base, width, 0, 0)
+        return header + pack_bits(values - np.uint32(base), width)
+    if codec == RLE:
+        starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+        lengths = np.diff(np.append(starts, count)).astype(np.uint32)
+        run_values = values[starts] - np.uint32(base)
+        width, run_width = _width(int(run_values.max())), _width(int(lengths.max()))
+        header = struct.pack(HEADER_FORMAT, RLE, count, base, width, len(starts), run_width)
+        return header + pack_bits(run_values, width) + pack_bits(lengths, run_width)
+    raise ValueError(f"Unknown codec: {codec}")
+
+
+def _runs(data: bytes):
+    """Returns (run values, run lengths) of an RLE page, run values still relative to base."""
+    _, _, _, width, runs, run_width = struct.unpack_from(HEADER_FORMAT, data)
+    values_size = _packed_size(runs, width)
+    run_values = unpack_bits(data[HEADER_SIZE:HEADER_SIZE + values_size], runs, width)
+    lengths = unpack_bits(data[HEADER_SIZE + values_size:], runs, run_width)
+    return run_values, lengths
+
+
+def decode(data: bytes) -> np.ndarray:
+    """Decodes a page back into an array of uint32 values."""
+    codec, count, base, width, _, _ = struct.unpack_from(HEADER_FORMAT, data)
+    if codec == RAW:
+        return np.frombuffer(data, dtype='<u4', offset=HEADER_SIZE, count=count).astype(np.uint32)
+    if codec in (BITPACK, FOR):
+        return unpack_bits(data[HEADER_SIZE:], count, width) + np.uint32(base)
+    if codec == RLE:
+        run_values, lengths = _runs(data)
+        return np.repeat(run_values + np.uint32(base), lengths)
+    raise ValueError(f"Unknown codec: {codec}")
+
+
+def range_mask(data: bytes, low: int, high: int) -> np.ndarray:
+    """Evaluates low <= value <= high on an encoded page without fully decoding it.
+
+    FOR pages compare the packed offsets against the shifted bounds, and RLE pages
+    evaluate the predicate once per run.
+    """
+    codec, count, base, width, _, _ = struct.unpack_from(HEADER_FORMAT, data)
+    if codec in (RAW, BITPACK):
+        values = decode(data)
+        return (values >= low) & (values <= high)
+
+    # every value of the page lies in [base, base + 2^width - 1]
+    if high < base or low > base + (1 << width) - 1:
+        return np.zeros(count, dtype=bool)
+    low, high = max(low - base, 0), high - base
+    if codec == FOR:
+        offsets = unpack_bits(data[HEADER_SIZE:], count, width)
+        return (offsets >= low) & (offsets <= high)
+    run_values, lengths = _runs(data)
+    return np.repeat((run_values >= low) & (run_values <= high), lengths)
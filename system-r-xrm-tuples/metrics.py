@@ -0,0 +1,131 @@
+"""Counters and timers shared by the columnar, phase1, xrd and v20 layouts.
+
+Page reads are counted with record_read() and recorded into the Stats of the
+innermost `with collect():` block; bench.py and the layouts' bench commands
+read bytes_read, pages_read and the timers from it. Worker processes collect
+their own Stats, which merge() adds to the caller's block. @timed wraps
+functions only when METRICS=1 is set at import time, and collect(trace=True)
+keeps the timed calls for export_trace() as a Chrome trace.
+"""
+import os
+import json
+import time
+import functools
+import inspect
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Optional
+
+ENABLED = os.environ.get('METRICS', '0') not in ('', '0')
+
+
+class Stats:
+    """Counters and timers collected while running one query."""
+
+    def __init__(self, name: Optional[str] = None, trace: bool = False):
+        self.name = name
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)  # seconds spent in each timed function
+        self.calls = defaultdict(int)
+        self.events = [] if trace else None  # (name, start, duration) for trace export
+        self.elapsed = 0.0
+
+    def add_time(self, name: str, start: float, duration: float) -> None:
+        self.timers[name] += duration
+        self.calls[name] += 1
+        if self.events is not None:
+            self.events.append((name, start, duration))
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'elapsed': self.elapsed, 'counters': dict(self.counters),
+                'timers': dict(self.timers), 'calls': dict(self.calls)}
+
+    def report(self) -> str:
+        lines = [f"{self.name or 'query'}: {self.elapsed:.4f}s"]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"  {name:<28} {value}")
+        for name, seconds in sorted(self.timers.items(), key=lambda item: -item[1]):
+            lines.append(f"  {name:<28} {seconds:.4f}s in {self.calls[name]} calls")
+        return '\n'.join(lines)
+
+    def export_trace(self, path: str) -> None:
+        """Writes the recorded timer events in Chrome trace format (chrome://tracing, Perfetto)."""
+        events = [{'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': os.getpid(), 'tid': 0}
+                  for name, start, duration in self.events or []]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'otherData': self.to_dict()}, f)
+
+
+_active: Optional[Stats] = None
+
+
+def incr(name: str, n: int = 1) -> None:
+    if _active is not None:
+        _active.counters[name] += n
+
+
+def record_read(nbytes: int, pages: int = 0) -> None:
+    """Counts one file open and read of nbytes (and the pages it covered)."""
+    if _active is not None:
+        _active.counters['file_opens'] += 1
+        _active.counters['bytes_read'] += nbytes
+        if pages:
+            _active.counters['pages_read'] += pages
+
+
+def merge(stats: Stats) -> None:
+    """Adds the counters and timers of Stats collected elsewhere, e.g. in a worker process, to the active block."""
+    if _active is not None:
+        for name, value in stats.counters.items():
+            _active.counters[name] += value
+        for name, seconds in stats.timers.items():
+            _active.timers[name] += seconds
+            _active.calls[name] += stats.calls[name]
+
+
+@contextmanager
+def collect(name: Optional[str] = None, trace: bool = False):
+    """Collects counters and timers for everything run inside the block."""
+    global _active
+    stats, previous = Stats(name, trace), _active
+    _active = stats
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.elapsed = time.perf_counter() - start
+        _active = previous
+
+
+def timed(fn):
+    """Records the time spent in fn (and for generators, in producing each item)."""
+    if not ENABLED:
+        return fn
+    name = fn.__qualname__
+
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generator_wrapper(*args, **kwargs):
+            generator = fn(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    if _active is not None:
+                        _active.add_time(name, start, time.perf_counter() - start)
+                yield item
+        return generator_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _active.add_time(name, start, time.perf_counter() - start)
+    return wrapper
@@ -4,5 +4,5 @@
 uv run python -m cProfile -o prof 0.py
 uv run gprof2dot --colour-nodes-by-selftime -f pstats prof | dot -Tpng -o output.png
 
-# line-based profiling
-uv run kernprof -l -v 0.py
+# per-query I/O counters and function timers
+METRICS=1 uv run python 0.py
@@ -1,8 +1,12 @@
 import os
+import sys
 import random
 import struct
 from typing import Generator, List, Tuple
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import metrics
+
 class Relation:
     def __init__(self, name: str, schema: List[str], N: int = 100000):
         self.name = name
@@ -21,6 +25,7 @@ class Relation:
             with open(relation_file, 'rb') as rf:
                 rf.seek((i & 0x3FFFFF) * 4)
                 tid = struct.unpack('I', rf.read(4))[0]
+                metrics.record_read(4)
                 yield tid
 
     def get_tuple(self, tid: int) -> Tuple[int]:
@@ -33,6 +38,7 @@ class Relation:
             tuple_address = struct.unpack('I', tf.read(4))[0]
             tf.seek(tuple_address * 4)
             tuple_data = struct.unpack('III', tf.read(12))
+        metrics.record_read(16)
         return tuple_data
 
     def save_field_value(self, field_name: str, value: int) -> int:
@@ -82,10 +88,11 @@ class Relation:
 
 
 # Example usage
-relation_name = "employee"
-relation_schema = ["employee_id", "age", "salary"]
-relation = Relation(relation_name, relation_schema, 100_000)
-# Scan the relation and print TIDs
-for tid in relation.scan():
-    print(tid)
-    print(relation.get_tuple(tid))
+if __name__ == '__main__':
+    relation_name = "employee"
+    relation_schema = ["employee_id", "age", "salary"]
+    relation = Relation(relation_name, relation_schema, 100_000)
+    # Scan the relation and print TIDs
+    for tid in relation.scan():
+        print(tid)
+        print(relation.get_tuple(tid))
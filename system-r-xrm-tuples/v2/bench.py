@@ -0,0 +1,315 @@
+"""Benchmark driver that runs a common workload against every tuple layout.
+
+Each (layout, N) pair runs in its own process and scratch directory, so peak
+RSS and on-disk state are not shared between runs.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import importlib.util
+import subprocess
+from typing import Dict, List, Optional
+
+import numpy as np
+
+V2_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(V2_DIR)
+SCHEMA = ["employee_id", "age", "salary"]
+sys.path[:0] = [V2_DIR, ROOT_DIR]
+
+import metrics
+
+# Workload constants shared by every layout; point lookups use whichever field the layout has
+POINT_LOOKUP = {'employee_id': 4242, 'salary': 54321}
+RANGE = (50000, 51000)
+CONJUNCTION = {'salary': (80001, None), 'age': (41, None)}
+STRING_VALUE = 'JOHN'
+STRING_PREFIX = 'J'
+AGE_VALUE = 30
+WORKLOADS = ['point_lookup', 'range_select', 'conjunction', 'string_equal', 'string_prefix', 'value_scan', 'full_scan']
+
+
+def load_module(name: str, path: str):
+    """Imports a layout by file path (0.py and 20.py are not valid module names).
+
+    The module is registered under its name, so worker processes can pickle its classes.
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Layout:
+    """A tuple layout under test. Workloads a layout cannot answer return None."""
+    name = None
+
+    def load(self, N: int, seed: int) -> None:
+        raise NotImplementedError
+
+    def build_indexes(self) -> None:
+        pass
+
+    def point_lookup(self, lookup: Dict[str, int]) -> Optional[int]:
+        return None
+
+    def range_select(self, low: int, high: int) -> Optional[int]:
+        return None
+
+    def conjunction(self, ranges: Dict) -> Optional[int]:
+        return None
+
+    def string_equal(self, value: str) -> Optional[int]:
+        return None
+
+    def string_prefix(self, prefix: str) -> Optional[int]:
+        return None
+
+    def value_scan(self, value: int) -> Optional[int]:
+        return None
+
+    def full_scan(self) -> Optional[int]:
+        return None
+
+
+class ColumnarLayout(Layout):
+    """In-memory/paged columnar TupleStorageSystem from 0.py, schema (name, age, salary)."""
+    name = 'columnar'
+
+    def __init__(self, workers: int):
+        self.module = load_module('columnar', os.path.join(ROOT_DIR, '0.py'))
+
+    def load(self, N, seed):
+        import random
+        random.seed(seed)
+        self.storage = self.module.TupleStorageSystem(['name', 'age', 'salary'])
+        self.storage.create_tuples(N)
+
+    def build_indexes(self):
+        self.storage.build_string_index('name')
+        self.storage.build_bitmap_index('age')
+        self.storage.build_bitmap_index('salary', bin_width=1000, encoding='range')
+
+    def point_lookup(self, lookup):
+        # the relation has no employee_id, so look up an exact salary instead
+        return len(self.storage.select_bitmap({'salary': (lookup['salary'], lookup['salary'])}))
+
+    def range_select(self, low, high):
+        return len(self.storage.select_bitmap({'salary': (low, high)}))
+
+    def conjunction(self, ranges):
+        return len(self.storage.select_bitmap(ranges))
+
+    def string_equal(self, value):
+        return len(self.storage.select_string_equal('name', value))
+
+    def string_prefix(self, prefix):
+        return len(self.storage.select_string_prefix('name', prefix))
+
+    def value_scan(self, value):
+        return len(self.storage.select_where({'age': (value, value)}))
+
+    def full_scan(self):
+        return len(self.storage.select_where({}))
+
+
+class XRMLayout(Layout):
+    """Shared driver for the page-based phase1 (row) and xrd (indirected) layouts."""
+
+    def __init__(self, workers: int):
+        self.module = load_module(self.name, os.path.join(V2_DIR, f'{self.name}.py'))
+        self.workers = workers
+
+    def load(self, N, seed):
+        self.relation = self.module.Relation('employee', SCHEMA, N)
+        self.relation.generate(seed, self.workers)
+
+    def build_indexes(self):
+        self.indexes = {'age': self.module.build_bitmap_index(self.relation, 'age'),
+                        'salary': self.module.build_bitmap_index(self.relation, 'salary', 1000, 'range')}
+
+    def point_lookup(self, lookup):
+        value = lookup['employee_id']
+        return len(self.module.find_with_value_parallel(self.relation, 'employee_id', value, self.workers))
+
+    def range_select(self, low, high):
+        return len(self.module.find_with_bitmaps(self.relation, self.indexes, {'salary': (low, high)}))
+
+    def conjunction(self, ranges):
+        return len(self.module.find_with_bitmaps(self.relation, self.indexes, ranges))
+
+    def value_scan(self, value):
+        return sum(1 for _ in self.module.find_with_value(self.relation, 'age', value))
+
+    def full_scan(self):
+        from pages import page_count
+        count = 0
+        for page_num in range(page_count(self.relation.N)):
+            columns = [self.relation.read_page_column(page_num, field)[1] for field in SCHEMA]
+            count += len(columns[0])
+        return count
+
+
+class Phase1Layout(XRMLayout):
+    name = 'phase1'
+
+
+class XrdLayout(XRMLayout):
+    name = 'xrd'
+
+
+class V20Layout(Layout):
+    """The original 20.py layout; it generates in its constructor and only offers a TID scan."""
+    name = 'v20'
+
+    def __init__(self, workers: int):
+        self.module = load_module('v20', os.path.join(V2_DIR, '20.py'))
+
+    def load(self, N, seed):
+        import random
+        random.seed(seed)
+        self.relation = self.module.Relation('employee', SCHEMA, N)
+
+    def full_scan(self):
+        return sum(1 for _ in self.relation.scan())
+
+
+LAYOUTS = {layout.name: layout for layout in [ColumnarLayout, Phase1Layout, XrdLayout, V20Layout]}
+
+
+def measure(fn, repeat: int) -> Dict:
+    """Runs fn repeat times; bytes_read comes from the metrics counters, so it includes memory-mapped reads
+    and the reads of worker processes."""
+    latencies, read, count = [], 0, None
+    for _ in range(repeat):
+        with metrics.collect() as stats:
+            start = time.perf_counter()
+            count = fn()
+            latencies.append(time.perf_counter() - start)
+        read += stats.counters['bytes_read']
+        if count is None:
+            return None
+    return {
+        'result_count': count,
+        'latency_mean': float(np.mean(latencies)),
+        'latency_p50': float(np.percentile(latencies, 50)),
+        'latency_p95': float(np.percentile(latencies, 95)),
+        'latency_p99': float(np.percentile(latencies, 99)),
+        'bytes_read': read // repeat,
+    }
+
+
+def run_layout(name: str, N: int, seed: int, repeat: int, workers: int) -> List[Dict]:
+    """Runs the whole workload against one layout in the current directory."""
+    layout = LAYOUTS[name](workers)
+    results = []
+
+    def record(workload, stats):
+        if stats is None:
+            return
+        stats.update(layout=name, N=N, workload=workload)
+        stats['throughput_tuples_per_sec'] = N / stats['latency_p50'] if stats['latency_p50'] else None
+        results.append(stats)
+
+    record('load', measure(lambda: layout.load(N, seed) or N, 1))
+    if type(layout).build_indexes is not Layout.build_indexes:
+        record('index_build', measure(lambda: layout.build_indexes() or 0, 1))
+    queries = {
+        'point_lookup': lambda: layout.point_lookup(POINT_LOOKUP),
+        'range_select': lambda: layout.range_select(*RANGE),
+        'conjunction': lambda: layout.conjunction(CONJUNCTION),
+        'string_equal': lambda: layout.string_equal(STRING_VALUE),
+        'string_prefix': lambda: layout.string_prefix(STRING_PREFIX),
+        'value_scan': lambda: layout.value_scan(AGE_VALUE),
+        'full_scan': layout.full_scan,
+    }
+    for workload in WORKLOADS:
+        record(workload, measure(queries[workload], repeat))
+
+    # worker processes count too: add the peak of the largest one that has exited
+    peak_rss_kb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    for stats in results:
+        stats['peak_rss_kb'] = peak_rss_kb
+    return results
+
+
+def run_isolated(name: str, N: int, args) -> List[Dict]:
+    """Runs one layout in a child process inside a scratch directory."""
+    workdir = tempfile.mkdtemp(prefix=f'bench-{name}-', dir=args.workdir)
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__), '--child', name, '--N', str(N),
+               '--seed', str(args.seed), '--repeat', str(args.repeat), '--workers', str(args.workers)]
+        child = subprocess.run(cmd, cwd=workdir, capture_output=True, text=True)
+        if child.returncode != 0:
+            raise RuntimeError(f"{name} N={N} failed:\n{child.stderr}")
+        return json.loads(child.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def find_regressions(results: List[Dict], baseline: List[Dict], tolerance: float, min_delta: float) -> List[str]:
+    """Compares median latencies against a baseline run.
+
+    Changes smaller than min_delta seconds are treated as noise.
+    """
+    previous = {(r['layout'], r['N'], r['workload']): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result['layout'], result['N'], result['workload']))
+        if old is None or not old['latency_p50']:
+            continue
+        ratio = result['latency_p50'] / old['latency_p50']
+        if ratio > 1 + tolerance and result['latency_p50'] - old['latency_p50'] > min_delta:
+            regressions.append(f"{result['layout']} N={result['N']} {result['workload']}: "
+                               f"{old['latency_p50']:.4f}s -> {result['latency_p50']:.4f}s ({ratio:.2f}x)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every tuple layout with a common workload")
+    parser.add_argument('--layouts', nargs='+', default=['columnar', 'phase1', 'xrd', 'v20'], choices=sorted(LAYOUTS))
+    parser.add_argument('--N', type=int, nargs='+', default=[100000, 1000000], help='Relation sizes to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of every query, for latency percentiles')
+    parser.add_argument('--workers', type=int, default=1, help='Processes used by layouts that can parallelize')
+    parser.add_argument('--workdir', default=None, help='Where the scratch directories are created')
+    parser.add_argument('--output', default='bench.json', help='Where to write the JSON results')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed median latency increase (0.2 = 20%%)')
+    parser.add_argument('--min-delta', type=float, default=0.001, help='Ignore latency changes below this many seconds')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_layout(args.child, args.N[0], args.seed, args.repeat, args.workers)))
+        return
+
+    results = []
+    for N in args.N:
+        for name in args.layouts:
+            for stats in run_isolated(name, N, args):
+                results.append(stats)
+                print(f"{name:<10} N={N:<10} {stats['workload']:<14} p50={stats['latency_p50']:.4f}s "
+                      f"p99={stats['latency_p99']:.4f}s read={stats['bytes_read']} rss={stats['peak_rss_kb']}KB")
+
+    with open(args.output, 'w') as f:
+        json.dump({'seed': args.seed, 'repeat': args.repeat, 'workers': args.workers, 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f)['results'], args.tolerance, args.min_delta)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import multiprocessing
+from functools import partial
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+import metrics
+from bitmap import Bitmap, BitmapIndex
+
+# TIDs are page_num << 16 | offset, so every page file holds at most 64K tuples
+PAGE_BITS = 16
+PAGE_SIZE = 1 << PAGE_BITS
+OFFSET_MASK = PAGE_SIZE - 1
+
+# inclusive value ranges used when generating random data for each field
+FIELD_RANGES = {
+    'employee_id': (1, 100000),
+    'age': (18, 65),
+    'salary': (30000, 120000),
+}
+
+
+def read_page_file(path: str) -> np.ndarray:
+    """Reads a whole relation, tuple or field page file as uint32 values."""
+    data = np.fromfile(path, dtype=np.uint32)
+    metrics.record_read(data.nbytes, pages=1)
+    return data
+
+
+def page_count(N: int) -> int:
+    """Returns the number of pages needed to hold N tuples."""
+    return (N + OFFSET_MASK) >> PAGE_BITS
+
+
+def page_slices(N: int) -> List[Tuple[int, int, int]]:
+    """Returns (page_num, start, count) for every page of an N-tuple relation."""
+    return [(page_num, page_num << PAGE_BITS, min(PAGE_SIZE, N - (page_num << PAGE_BITS)))
+            for page_num in range(page_count(N))]
+
+
+def page_tids(page_num: int, count: int) -> np.ndarray:
+    """Returns the TIDs of the first `count` tuples of a page."""
+    return (np.uint32(page_num << PAGE_BITS) | np.arange(count, dtype=np.uint32)).astype(np.uint32)
+
+
+def generate_columns(schema: List[str], page_num: int, count: int, seed: int) -> Dict[str, np.ndarray]:
+    """Generates one page of random column data.
+
+    Every page gets its own RNG stream derived from (seed, page_num), so the
+    data does not depend on how pages are spread across worker processes.
+    """
+    rng = np.random.default_rng([seed, page_num])
+    columns = {}
+    for field in schema:
+        low, high = FIELD_RANGES[field]
+        columns[field] = rng.integers(low, high + 1, size=count, dtype=np.uint32)
+    return columns
+
+
+def collect_worker(fn: Callable, item) -> Tuple[object, metrics.Stats]:
+    """Runs fn(item) in a worker process, returning its result with the metrics it recorded."""
+    with metrics.collect() as stats:
+        result = fn(item)
+    return result, stats
+
+
+def run_pages(fn: Callable, items: Iterable, workers: int = 1) -> Iterator:
+    """Applies fn to every item, optionally across worker processes, yielding results in order.
+
+    Metrics recorded by the workers are merged into the caller's active collect() block.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        yield from map(fn, items)
+        return
+    with multiprocessing.Pool(min(workers, len(items))) as pool:
+        for result, stats in pool.imap(partial(collect_worker, fn), items):
+            metrics.merge(stats)
+            yield result
+
+
+def split_pages(num_pages: int, parts: int) -> List[range]:
+    """Splits page numbers 0..num_pages-1 into at most `parts` contiguous ranges."""
+    parts = max(1, min(parts, num_pages))
+    bounds = [num_pages * i // parts for i in range(parts + 1)]
+    return [range(bounds[i], bounds[i + 1]) for i in range(parts)]
+
+
+def find_with_value_parallel(relation, field_name: str, value: int, workers: int) -> np.ndarray:
+    """Finds all tuples with the specified field value, splitting the pages across worker processes.
+
+    Every worker runs relation.find_in_pages over a range of pages and returns a
+    compact array of matching TIDs; the arrays are merged into a single TID-ordered array.
+    """
+    # a few ranges per worker keeps the processes busy when some ranges match more than others
+    page_ranges = split_pages(page_count(relation.N), workers * 4)
+    results = run_pages(partial(relation.find_in_pages, field_name, value), page_ranges, workers)
+    return np.sort(np.concatenate(list(results)))
+
+
+def build_bitmap_index(relation, field_name: str, bin_width: int = 1, encoding: str = 'equality') -> BitmapIndex:
+    """Builds a bitmap index over one field, keyed by TID, from relation.read_page_column."""
+    pages = [relation.read_page_column(page_num, field_name) for page_num in range(page_count(relation.N))]
+    tids = np.concatenate([tids for tids, _ in pages])
+    values = np.concatenate([values for _, values in pages])
+    order = np.argsort(tids, kind='stable')
+    return BitmapIndex.build(tids[order], values[order], bin_width, encoding)
+
+
+def find_with_bitmaps(relation, indexes: Dict[str, BitmapIndex], ranges: Dict[str, Tuple]) -> Bitmap:
+    """Finds the tuples matching every (low, high) range in ranges using only bitmap operations.
+
+    Tuple data is only read (through relation.read_values) for rows in bins that a range covers partially.
+    """
+    result = None
+    for field_name, (low, high) in ranges.items():
+        matches = indexes[field_name].range(low, high, partial(relation.read_values, field_name))
+        result = matches if result is None else result & matches
+    return result
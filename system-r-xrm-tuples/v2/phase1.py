@@ -1,10 +1,23 @@
 from tqdm import tqdm
-from line_profiler import profile
 import os
-import random
+import sys
+import json
+import shutil
 import struct
 import argparse
-from typing import Generator, List, Tuple
+from bisect import bisect_left, bisect_right
+from functools import partial
+from typing import Callable, Dict, Generator, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import codegen
+import metrics
+from pages import PAGE_BITS, PAGE_SIZE, OFFSET_MASK, generate_columns, page_count, page_slices, page_tids, read_page_file, run_pages, find_with_value_parallel, build_bitmap_index, find_with_bitmaps
+from zonemap import ZoneMap
+
+TUPLE_FIELD = struct.Struct('I')  # every field of a tuple page row is one unsigned int
 
 class Relation:
     def __init__(self, name: str, schema: List[str], N: int = 100000):
@@ -12,21 +25,39 @@ class Relation:
         self.schema = schema
         self.relation_dir = "phase1/relations"
         self.tuple_dir = "phase1/tuples"
+        self.zonemap_dir = "phase1/zonemaps"
+        self.sort_dir = "phase1/sort"
+        self.meta_file = "phase1/meta.json"
         self.N = N
 
-    @profile
-    def scan(self):
-        """Scans the relation and returns a generator of TIDs."""
-        for i in tqdm(range(self.N)):
-            page_num = i >> 16
-            offset = i & 0xFFFF
-            relation_file = os.path.join(self.relation_dir, f"{page_num}.dat")
-            with open(relation_file, 'rb') as rf:
-                rf.seek(offset * 4)
-                tid = struct.unpack('I', rf.read(4))[0]
-                yield tid
-
-    @profile
+    @metrics.timed
+    def scan(self, page_filter: Optional[Callable[[ZoneMap], bool]] = None):
+        """Scans the relation and returns a generator of TIDs.
+
+        If page_filter is given, pages whose zone map it rejects are skipped without being read.
+        """
+        with tqdm(total=self.N) as progress:
+            for page_num, start, count in page_slices(self.N):
+                if page_filter is not None:
+                    zone_map = self.get_zone_map(page_num)
+                    if zone_map is not None and not page_filter(zone_map):
+                        metrics.incr('pages_skipped')
+                        progress.update(count)
+                        continue
+                relation_file = os.path.join(self.relation_dir, f"{page_num}.dat")
+                for offset in range(count):
+                    with open(relation_file, 'rb') as rf:
+                        rf.seek(offset * 4)
+                        tid = struct.unpack('I', rf.read(4))[0]
+                    metrics.record_read(4)
+                    progress.update()
+                    yield tid
+
+    def get_zone_map(self, page_num: int) -> Optional[ZoneMap]:
+        """Returns the zone map of a tuple page, or None if it has none."""
+        return ZoneMap.load(self.schema, os.path.join(self.zonemap_dir, f"{page_num}.zm"))
+
+    @metrics.timed
     def get_tuple(self, tid: int) -> Tuple[int]:
         """Returns the tuple data for the provided TID."""
         page_num = tid >> 16
@@ -35,13 +66,45 @@ class Relation:
         with open(tuple_file, 'rb') as tf:
             tf.seek(offset * (4 * len(self.schema)))  # Assume each int is 4 bytes
             tuple_data = struct.unpack('I' * len(self.schema), tf.read(4 * len(self.schema)))
+        metrics.record_read(4 * len(self.schema))
         return tuple_data
 
-    @profile
+    @metrics.timed
     def get_tuple_values(self, tid: int) -> List[int]:
         """Returns a list of field values for the provided TID."""
         return list(self.get_tuple(tid))
 
+    def read_page_column(self, page_num: int, field_name: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Reads a whole page at once, returning its TIDs and their values of one field."""
+        tids = read_page_file(os.path.join(self.relation_dir, f"{page_num}.dat"))
+        rows = read_page_file(os.path.join(self.tuple_dir, f"{page_num}.dat"))
+        rows = rows.reshape(-1, len(self.schema))
+        return tids, rows[tids & OFFSET_MASK, self.schema.index(field_name)]
+
+    def read_values(self, field_name: str, tids: np.ndarray) -> np.ndarray:
+        """Returns the values of one field for ascending TIDs, reading each page once."""
+        field = self.schema.index(field_name)
+        values = np.empty(len(tids), dtype=np.uint32)
+        page_nums = tids >> PAGE_BITS
+        for page_num in np.unique(page_nums):
+            in_page = page_nums == page_num
+            rows = read_page_file(os.path.join(self.tuple_dir, f"{page_num}.dat"))
+            rows = rows.reshape(-1, len(self.schema))
+            values[in_page] = rows[tids[in_page] & OFFSET_MASK, field]
+        return values
+
+    def find_in_pages(self, field_name: str, value: int, page_nums: range) -> np.ndarray:
+        """Returns the TIDs in the given pages whose field equals value, skipping pages by zone map."""
+        matches = [np.zeros(0, dtype=np.uint32)]
+        for page_num in page_nums:
+            zone_map = self.get_zone_map(page_num)
+            if zone_map is not None and not zone_map.may_contain(field_name, value):
+                metrics.incr('pages_skipped')
+                continue
+            tids, values = self.read_page_column(page_num, field_name)
+            matches.append(tids[values == value])
+        return np.concatenate(matches)
+
     def save_tuple(self, idx: int, tuple_data: List[int]) -> int:
         """Saves the tuple data to the tuple file. Returns TID"""
         page_num = idx >> 16
@@ -50,43 +113,252 @@ class Relation:
             offset = os.path.getsize(tuple_file) // (4 * len(self.schema))
             tf.seek(offset * (4 * len(self.schema)))
             tf.write(struct.pack('I' * len(tuple_data), *tuple_data))
+
+        # keep the page's zone map covering everything appended to it
+        os.makedirs(self.zonemap_dir, exist_ok=True)
+        zone_map = self.get_zone_map(page_num)
+        if zone_map is None:
+            # the page may hold rows written before it had a zone map; cover them too
+            rows = read_page_file(tuple_file).reshape(-1, len(self.schema))[:offset]
+            zone_map = ZoneMap.from_columns(self.schema, {field: rows[:, i] for i, field in enumerate(self.schema)})
+        sort_key = self.sort_key
+        if sort_key is not None:
+            # the relation stays sorted only if the tuple lands at the very end in key order
+            value = tuple_data[self.schema.index(sort_key)]
+            last_page = page_count(self.N) - 1
+            if page_num != last_page or zone_map.count == 0 or value < zone_map.maxs[sort_key]:
+                self.save_meta({**self.load_meta(), 'sort_key': None})
+        zone_map.update(tuple_data)
+        zone_map.save(os.path.join(self.zonemap_dir, f"{page_num}.zm"))
         return page_num << 16 | offset
 
-    def generate(self) -> None:
-        """Generates N tuples of random data for the provided schema."""
-        os.makedirs("phase1/relations", exist_ok=True)
-        os.makedirs("phase1/tuples", exist_ok=True)
-        for i in tqdm(range(self.N)):
-            page_num = i >> 16  # 10 bits for page number
-
-            # generate the data for this tuple
-            tuple_data = []
-            for field in self.schema:
-                if field == 'employee_id':
-                    value = random.randint(1, 100000)
-                elif field == 'age':
-                    value = random.randint(18, 65)
-                elif field == 'salary':
-                    value = random.randint(30000, 120000)
-                tuple_data.append(value)
-
-            tid = self.save_tuple(i, tuple_data)
-
-            # save the tid to the list of tids for the relation
-            relation_file = os.path.join("phase1/relations", f"{page_num}.dat")
-            with open(relation_file, 'ab') as rf:
-                rf.write(struct.pack('I', tid))
-
-
-@profile
-def find_with_value(relation: Relation, field_name: str, value: int) -> Generator[int, None, None]:
-    """Finds all tuples with the specified field value."""
-    for tid in relation.scan():
+    def generate(self, seed: int = 0, workers: int = 1) -> None:
+        """Generates N tuples of random data for the provided schema, one page at a time."""
+        os.makedirs(self.relation_dir, exist_ok=True)
+        os.makedirs(self.tuple_dir, exist_ok=True)
+        os.makedirs(self.zonemap_dir, exist_ok=True)
+        # the new data is unsorted, so lookups must not binary search it
+        self.save_meta({**self.load_meta(), 'sort_key': None})
+        pages = page_slices(self.N)
+        for _ in tqdm(run_pages(partial(self.generate_page, seed), pages, workers), total=len(pages)):
+            pass
+
+    def generate_page(self, seed: int, page: Tuple[int, int, int]) -> None:
+        """Generates and writes a single page of tuples along with its TIDs."""
+        page_num, start, count = page
+        columns = generate_columns(self.schema, page_num, count, seed)
+
+        # row format: the fields of each tuple are stored next to each other
+        rows = np.column_stack([columns[field] for field in self.schema])
+        self.write_page(page_num, rows)
+
+    def write_page(self, page_num: int, rows: np.ndarray) -> None:
+        """Writes a page of rows in TID order, along with its zone map and TIDs."""
+        with open(os.path.join(self.tuple_dir, f"{page_num}.dat"), 'wb') as tf:
+            tf.write(rows.astype(np.uint32).tobytes())
+        columns = {field: rows[:, i] for i, field in enumerate(self.schema)}
+        ZoneMap.from_columns(self.schema, columns).save(os.path.join(self.zonemap_dir, f"{page_num}.zm"))
+
+        # tuples are written in order, so the offset of each tuple is its index in the page
+        with open(os.path.join(self.relation_dir, f"{page_num}.dat"), 'wb') as rf:
+            rf.write(page_tids(page_num, len(rows)).tobytes())
+
+    def read_page_rows(self, page_num: int) -> np.ndarray:
+        """Reads the rows of a page in the order the relation lists them."""
+        tids = read_page_file(os.path.join(self.relation_dir, f"{page_num}.dat"))
+        rows = read_page_file(os.path.join(self.tuple_dir, f"{page_num}.dat"))
+        return rows.reshape(-1, len(self.schema))[tids & OFFSET_MASK]
+
+    def load_meta(self) -> dict:
+        if not os.path.exists(self.meta_file):
+            return {}
+        with open(self.meta_file) as mf:
+            return json.load(mf)
+
+    def save_meta(self, meta: dict) -> None:
+        with open(self.meta_file, 'w') as mf:
+            json.dump(meta, mf)
+
+    @property
+    def sort_key(self) -> Optional[str]:
+        """The field the relation is clustered on, if any."""
+        return self.load_meta().get('sort_key')
+
+    def cluster(self, field_name: str, memory_limit: int = 256 << 20) -> None:
+        """Rewrites the relation sorted on field_name and records it as the sort key.
+
+        Relations that fit in memory_limit bytes are sorted in memory; larger ones are
+        sorted into runs that are spilled to disk and merged.
+        """
+        key = self.schema.index(field_name)
+        row_bytes = 4 * len(self.schema)
+        slices = page_slices(self.N)
+
+        if self.N * row_bytes <= memory_limit:
+            rows = np.concatenate([self.read_page_rows(page_num) for page_num, _, _ in slices])
+            blocks = [rows[np.argsort(rows[:, key], kind='stable')]]
+        else:
+            blocks = self._sorted_blocks(key, max(PAGE_SIZE, memory_limit // row_bytes))
+
+        # cut the sorted stream back into pages
+        page_num, pending = 0, np.zeros((0, len(self.schema)), dtype=np.uint32)
+        for block in blocks:
+            pending = np.concatenate([pending, block])
+            while len(pending) >= PAGE_SIZE:
+                self.write_page(page_num, pending[:PAGE_SIZE])
+                page_num, pending = page_num + 1, pending[PAGE_SIZE:]
+        if len(pending):
+            self.write_page(page_num, pending)
+
+        shutil.rmtree(self.sort_dir, ignore_errors=True)
+        self.save_meta({**self.load_meta(), 'sort_key': field_name})
+
+    def _sorted_blocks(self, key: int, run_rows: int) -> Generator[np.ndarray, None, None]:
+        """External sort: spills sorted runs of run_rows rows and yields merged blocks in key order."""
+        os.makedirs(self.sort_dir, exist_ok=True)
+        pages_per_run = max(1, run_rows // PAGE_SIZE)
+        runs = []
+        slices = page_slices(self.N)
+        for i in range(0, len(slices), pages_per_run):
+            rows = np.concatenate([self.read_page_rows(page_num) for page_num, _, _ in slices[i:i + pages_per_run]])
+            run_file = os.path.join(self.sort_dir, f"run_{len(runs)}.dat")
+            rows[np.argsort(rows[:, key], kind='stable')].tofile(run_file)
+            runs.append(np.memmap(run_file, dtype=np.uint32, mode='r').reshape(-1, len(self.schema)))
+
+        block_rows = max(1, run_rows // (len(runs) + 1))
+        positions = [0] * len(runs)
+        buffers = [run[:0] for run in runs]
+        while True:
+            for i, run in enumerate(runs):
+                if len(buffers[i]) == 0 and positions[i] < len(run):
+                    buffers[i] = np.array(run[positions[i]:positions[i] + block_rows])
+                    positions[i] += len(buffers[i])
+            if not any(len(buffer) for buffer in buffers):
+                return
+
+            # rows up to the smallest last key of a run with unread rows can never be undercut
+            pending = [buffer[-1, key] for i, buffer in enumerate(buffers) if positions[i] < len(runs[i])]
+            bound = min(pending) if pending else np.iinfo(np.uint32).max
+            taken = []
+            for i, buffer in enumerate(buffers):
+                cut = np.searchsorted(buffer[:, key], bound, side='right')
+                taken.append(buffer[:cut])
+                buffers[i] = buffer[cut:]
+            merged = np.concatenate(taken)
+            yield merged[np.argsort(merged[:, key], kind='stable')]
+
+    def _key_at(self, page_num: int, key: int, offset: int) -> int:
+        """Reads a single field of the tuple at offset in a page."""
+        with open(os.path.join(self.tuple_dir, f"{page_num}.dat"), 'rb') as tf:
+            tf.seek(offset * 4 * len(self.schema) + key * 4)
+            value = struct.unpack('I', tf.read(4))[0]
+        metrics.record_read(4)
+        return value
+
+    def lookup(self, field_name: str, low: int, high: int) -> Generator[int, None, None]:
+        """Returns TIDs with low <= field <= high by binary search on a relation clustered on field_name."""
+        if self.sort_key != field_name:
+            raise ValueError(f"Relation {self.name} is not clustered on {field_name}")
+        key = self.schema.index(field_name)
+
+        def page_zone_map(page_num: int) -> ZoneMap:
+            zone_map = self.get_zone_map(page_num)
+            if zone_map is None:
+                raise ValueError(f"Page {page_num} of relation {self.name} has no zone map; cluster it again")
+            return zone_map
+
+        # binary search over page boundaries for the first page that can hold low
+        slices = page_slices(self.N)
+        first = bisect_left(slices, low, key=lambda page: page_zone_map(page[0]).maxs[field_name])
+        for page_num, _, count in slices[first:]:
+            zone_map = page_zone_map(page_num)
+            if zone_map.mins[field_name] > high:
+                break
+
+            # then within the page for the slice of matching offsets
+            key_at = partial(self._key_at, page_num, key)
+            start = bisect_left(range(count), low, key=key_at) if zone_map.mins[field_name] < low else 0
+            end = bisect_right(range(count), high, key=key_at) if zone_map.maxs[field_name] > high else count
+            with open(os.path.join(self.relation_dir, f"{page_num}.dat"), 'rb') as rf:
+                rf.seek(start * 4)
+                tids = struct.unpack(f'{end - start}I', rf.read((end - start) * 4))
+            metrics.record_read(4 * len(tids))
+            yield from tids
+            if end < count:
+                break
+
+def compile_scan(relation: Relation, ranges: Dict[str, Tuple], projection: Optional[List[str]] = None) -> Callable:
+    """Compiles a scan for the tuples whose fields lie in every (low, high) range (either bound may be None).
+
+    The pipeline is called with the relation and the page numbers to scan and yields
+    the TIDs of the matches, or tuples of their projected fields. It skips pages by
+    zone map, reads each page whole and unpacks only the fields the query uses, at
+    their fixed offsets in the row.
+    """
+    shape = codegen.query_shape(('phase1', tuple(relation.schema)), ranges, projection)
+    return codegen.compile_pipeline(shape, partial(_scan_source, relation.schema, ranges, projection))
+
+
+def _scan_source(schema: List[str], ranges: Dict[str, Tuple], projection: Optional[List[str]]):
+    row_size = TUPLE_FIELD.size * len(schema)
+
+    def unpack(fields, indent):
+        return [f"{indent}{codegen.variable(field)} = unpack_field(rows, row + {schema.index(field) * TUPLE_FIELD.size})[0]"
+                for field in fields]
+
+    lines = ["def pipeline(relation, page_nums):",
+             "    for page_num in page_nums:"]
+    if ranges:
+        zone_test = ' and '.join(f"zone_map.may_overlap({field!r}, {0 if low is None else low!r}, "
+                                 f"{0xFFFFFFFF if high is None else high!r})" for field, (low, high) in ranges.items())
+        lines += ["        zone_map = relation.get_zone_map(page_num)",
+                  f"        if zone_map is not None and not ({zone_test}):",
+                  "            incr('pages_skipped')",
+                  "            continue"]
+    lines += ["        rows = read_file(os.path.join(relation.tuple_dir, f'{page_num}.dat'))",
+              "        for (tid,) in iter_tids(read_file(os.path.join(relation.relation_dir, f'{page_num}.dat'))):",
+              f"            row = (tid & {OFFSET_MASK}) * {row_size}"]
+    lines += unpack(ranges, ' ' * 12)
+    lines.append(f"            if {codegen.predicate_source(ranges)}:")
+    lines += unpack([field for field in projection or () if field not in ranges], ' ' * 16)
+    lines.append(f"                yield {codegen.result_source(projection, 'tid')}")
+    return lines, {'os': os, 'read_file': codegen.read_file,
+                   'iter_tids': TUPLE_FIELD.iter_unpack, 'unpack_field': TUPLE_FIELD.unpack_from}
+
+
+@metrics.timed
+def find_with_value(relation: Relation, field_name: str, value: int, compiled: bool = True) -> Generator[int, None, None]:
+    """Finds all tuples with the specified field value.
+
+    Unless compiled=False, the scan runs as a compiled pipeline (see compile_scan).
+    """
+    if relation.sort_key == field_name:
+        yield from relation.lookup(field_name, value, value)
+        return
+    if compiled:
+        yield from compile_scan(relation, {field_name: (value, value)})(relation, range(page_count(relation.N)))
+        return
+    for tid in relation.scan(lambda zone_map: zone_map.may_contain(field_name, value)):
         values = relation.get_tuple_values(tid)
         if values[relation.schema.index(field_name)] == value:
             yield tid
 
 
+@metrics.timed
+def find_in_range(relation: Relation, field_name: str, low: int, high: int, compiled: bool = True) -> Generator[int, None, None]:
+    """Finds all tuples whose field value lies in [low, high]."""
+    if relation.sort_key == field_name:
+        yield from relation.lookup(field_name, low, high)
+        return
+    if compiled:
+        yield from compile_scan(relation, {field_name: (low, high)})(relation, range(page_count(relation.N)))
+        return
+    for tid in relation.scan(lambda zone_map: zone_map.may_overlap(field_name, low, high)):
+        values = relation.get_tuple_values(tid)
+        if low <= values[relation.schema.index(field_name)] <= high:
+            yield tid
+
+
 def main():
     parser = argparse.ArgumentParser(description="Manage Relations")
     subparsers = parser.add_subparsers(dest='command')
@@ -94,10 +366,23 @@ def main():
     # Create subcommand
     create_parser = subparsers.add_parser('create', help='Create a new relation')
     create_parser.add_argument('--N', type=int, default=100000, help='Number of tuples to generate')
+    create_parser.add_argument('--seed', type=int, default=0, help='Seed for the random data')
+    create_parser.add_argument('--workers', type=int, default=1, help='Number of processes used to generate pages')
+
+    # Cluster subcommand
+    cluster_parser = subparsers.add_parser('cluster', help='Rewrite the relation sorted on a field')
+    cluster_parser.add_argument('--N', type=int, default=100000, help='Number of tuples in the relation')
+    cluster_parser.add_argument('--field', default='employee_id', help='Field to sort on')
+    cluster_parser.add_argument('--memory', type=int, default=256, help='Memory budget for sorting, in MB')
 
     # Benchmark subcommand (currently does nothing)
     bench_parser = subparsers.add_parser('bench', help='Run a benchmark')
     bench_parser.add_argument('--N', type=int, default=100000, help='Number of tuples to generate')
+    bench_parser.add_argument('--stats', action='store_true', help='Print I/O counters and timers for the query')
+    bench_parser.add_argument('--trace', default=None, help='Write a Chrome trace of the query to this file (needs METRICS=1)')
+    bench_parser.add_argument('--bitmap', action='store_true', help='Answer the query with a bitmap index')
+    bench_parser.add_argument('--workers', type=int, default=0, help='Run the scan in parallel across this many processes')
+    bench_parser.add_argument('--interpreted', action='store_true', help='Scan through the generic tuple-at-a-time path instead of a compiled pipeline')
 
     args = parser.parse_args()
     name = "employee"
@@ -105,12 +390,27 @@ def main():
 
     if args.command == 'create':
         relation = Relation(name, schema, args.N)
-        relation.generate()
+        relation.generate(args.seed, args.workers)
         print(f"Relation with {args.N} tuples.")
 
+    elif args.command == 'cluster':
+        relation = Relation(name, schema, args.N)
+        relation.cluster(args.field, args.memory << 20)
+        print(f"Relation clustered on {args.field}.")
+
     elif args.command == 'bench':
         relation = Relation(name, schema, args.N)
-        print(len(list(find_with_value(relation, 'age', 30))))
+        with metrics.collect('find_with_value', trace=args.trace is not None) as stats:
+            if args.bitmap:
+                print(len(find_with_bitmaps(relation, {'age': build_bitmap_index(relation, 'age')}, {'age': (30, 30)})))
+            elif args.workers:
+                print(len(find_with_value_parallel(relation, 'age', 30, args.workers)))
+            else:
+                print(len(list(find_with_value(relation, 'age', 30, compiled=not args.interpreted))))
+        if args.stats:
+            print(stats.report())
+        if args.trace:
+            stats.export_trace(args.trace)
 
 
 if __name__ == '__main__':
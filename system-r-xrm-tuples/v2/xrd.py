@@ -1,10 +1,23 @@
 from tqdm import tqdm
-from line_profiler import profile
 import os
-import random
+import sys
+import mmap
+import shutil
 import struct
 import argparse
-from typing import Generator, List, Tuple
+from contextlib import ExitStack
+from functools import partial
+from typing import Callable, Dict, Generator, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import codegen
+import metrics
+from compression import decode, encode, range_mask
+from pages import PAGE_BITS, OFFSET_MASK, generate_columns, page_count, page_slices, page_tids, read_page_file, run_pages, find_with_value_parallel, build_bitmap_index, find_with_bitmaps
+
+UINT = struct.Struct('I')  # TIDs, field addresses and uncompressed field values
 
 class Relation:
     def __init__(self, name: str, schema: List[str], N: int = 100000):
@@ -14,8 +27,11 @@ class Relation:
         self.tuple_dir = "xrd/tuples"
         self.field_dir = "xrd/fields"
         self.N = N
+        # compressed relations keep one encoded file per 64K-value page of every field
+        self.compressed = os.path.isdir(self.field_page_dir(schema[0]))
+        self.decoded_pages = {}  # field name -> (page number, decoded values) of the last page read
 
-    @profile
+    @metrics.timed
     def scan(self):
         """Scans the relation and returns a generator of TIDs."""
         for i in tqdm(range(self.N)):
@@ -25,9 +41,10 @@ class Relation:
             with open(relation_file, 'rb') as rf:
                 rf.seek(offset * 4)
                 tid = struct.unpack('I', rf.read(4))[0]
-                yield tid
+            metrics.record_read(4)
+            yield tid
 
-    @profile
+    @metrics.timed
     def get_tuple(self, tid: int) -> Tuple[int]:
         """Returns the tuple data for the provided TID."""
         page_num = tid >> 16
@@ -36,23 +53,97 @@ class Relation:
         with open(tuple_file, 'rb') as tf:
             tf.seek(offset * 12)  # Read 12 bytes for 3 integers (each 4 bytes)
             tuple_data = struct.unpack('III', tf.read(12))
+        metrics.record_read(12)
         return tuple_data
 
-    @profile
+    def field_page_dir(self, field_name: str) -> str:
+        return os.path.join(self.field_dir, field_name)
+
+    def read_field_page(self, field_name: str, page_num: int) -> bytes:
+        """Returns an encoded field page of a compressed relation."""
+        with open(os.path.join(self.field_page_dir(field_name), f"{page_num}.dat"), 'rb') as ff:
+            data = ff.read()
+        metrics.record_read(len(data), pages=1)
+        return data
+
+    def decode_field_page(self, field_name: str, page_num: int) -> np.ndarray:
+        cached = self.decoded_pages.get(field_name)
+        if cached is None or cached[0] != page_num:
+            cached = (page_num, decode(self.read_field_page(field_name, page_num)))
+            self.decoded_pages[field_name] = cached
+        return cached[1]
+
+    def read_field_values(self, field_name: str, field_addrs: np.ndarray) -> np.ndarray:
+        """Returns the field values at the provided offsets."""
+        if not self.compressed:
+            field_file = os.path.join(self.field_dir, f"{field_name}.dat")
+            metrics.record_read(4 * len(field_addrs))
+            return np.memmap(field_file, dtype=np.uint32, mode='r')[field_addrs]
+        values = np.empty(len(field_addrs), dtype=np.uint32)
+        page_nums = field_addrs >> PAGE_BITS
+        for page_num in np.unique(page_nums):
+            in_page = page_nums == page_num
+            values[in_page] = self.decode_field_page(field_name, int(page_num))[field_addrs[in_page] & OFFSET_MASK]
+        return values
+
+    @metrics.timed
     def get_field_value(self, field_name: str, offset: int) -> int:
         """Returns the field value at the provided offset."""
+        if self.compressed:
+            return int(self.decode_field_page(field_name, offset >> PAGE_BITS)[offset & OFFSET_MASK])
         field_file = os.path.join(self.field_dir, f"{field_name}.dat")
         with open(field_file, 'rb') as ff:
             ff.seek(offset * 4)
             value = struct.unpack('I', ff.read(4))[0]
+        metrics.record_read(4)
         return value
 
-    @profile
+    @metrics.timed
     def get_tuple_values(self, tid: int) -> List[int]:
         """Returns a list of field values for the provided TID."""
         tuple_data = self.get_tuple(tid)
         return [self.get_field_value(field, offset) for field, offset in zip(self.schema, tuple_data)]
 
+    def read_page_column(self, page_num: int, field_name: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Reads a whole page at once, returning its TIDs and their values of one field."""
+        tids = read_page_file(os.path.join(self.relation_dir, f"{page_num}.dat"))
+        rows = read_page_file(os.path.join(self.tuple_dir, f"{page_num}.dat"))
+        rows = rows.reshape(-1, len(self.schema))
+        field_addrs = rows[tids & OFFSET_MASK, self.schema.index(field_name)]
+        return tids, self.read_field_values(field_name, field_addrs)
+
+    def read_values(self, field_name: str, tids: np.ndarray) -> np.ndarray:
+        """Returns the values of one field for ascending TIDs, reading each page once."""
+        field = self.schema.index(field_name)
+        values = np.empty(len(tids), dtype=np.uint32)
+        page_nums = tids >> PAGE_BITS
+        for page_num in np.unique(page_nums):
+            in_page = page_nums == page_num
+            rows = read_page_file(os.path.join(self.tuple_dir, f"{page_num}.dat"))
+            rows = rows.reshape(-1, len(self.schema))
+            values[in_page] = self.read_field_values(field_name, rows[tids[in_page] & OFFSET_MASK, field])
+        return values
+
+    def find_in_pages(self, field_name: str, value: int, page_nums: range) -> np.ndarray:
+        """Returns the TIDs in the given pages whose field equals value."""
+        field = self.schema.index(field_name)
+        matches = [np.zeros(0, dtype=np.uint32)]
+        for page_num in page_nums:
+            if not self.compressed:
+                tids, values = self.read_page_column(page_num, field_name)
+                matches.append(tids[values == value])
+                continue
+            tids = read_page_file(os.path.join(self.relation_dir, f"{page_num}.dat"))
+            rows = read_page_file(os.path.join(self.tuple_dir, f"{page_num}.dat"))
+            field_addrs = rows.reshape(-1, len(self.schema))[tids & OFFSET_MASK, field]
+            if len(field_addrs) and np.all(field_addrs >> PAGE_BITS == page_num):
+                # the page's values all live in the matching field page: test them without decoding
+                mask = range_mask(self.read_field_page(field_name, page_num), value, value)
+                matches.append(tids[mask[field_addrs & OFFSET_MASK]])
+            else:
+                matches.append(tids[self.read_field_values(field_name, field_addrs) == value])
+        return np.concatenate(matches)
+
     def save_field_value(self, field_name: str, value: int) -> int:
         """Saves the field value in a separate file."""
         # Discussion point:
@@ -60,6 +151,8 @@ class Relation:
         # - however, this means that we would need to clean up the field file after deleting a tuple
         # - this would require us to scan the entire tuple file to see if the value is still in use
         # - this is a trade-off between space and time
+        if self.compressed:
+            raise ValueError("Compressed field files are read-only; regenerate the relation to add tuples")
         field_file = os.path.join(self.field_dir, f"{field_name}.dat")
         with open(field_file, 'ab') as ff:
             offset = os.path.getsize(field_file) // 4
@@ -76,36 +169,128 @@ class Relation:
             tf.write(struct.pack('III', *tuple_data))
         return (page_num << 16) | current_offset  # TID is page_num + offset in the last 16 bits
 
-    def generate(self) -> None:
-        """Generates N tuples of random data for the provided schema."""
+    def generate(self, seed: int = 0, workers: int = 1, compress: bool = False) -> None:
+        """Generates N tuples of random data for the provided schema, one page at a time.
+
+        With compress, every page of field values is stored with the codec that suits it best.
+        """
         os.makedirs(self.relation_dir, exist_ok=True)
         os.makedirs(self.tuple_dir, exist_ok=True)
         os.makedirs(self.field_dir, exist_ok=True)
 
         total_tuples = min(self.N, 2 ** 32)  # Ensure we do not exceed 32-bit TID
-        for i in tqdm(range(total_tuples)):
-            # Generate the data for this tuple
-            tuple_data = []
-            for field in self.schema:
-                if field == 'employee_id':
-                    value = random.randint(1, 100000)
-                elif field == 'age':
-                    value = random.randint(18, 65)
-                elif field == 'salary':
-                    value = random.randint(30000, 120000)
-                field_addr = self.save_field_value(field, value)
-                tuple_data.append(field_addr)
-
-            tid = self.save_tuple(i, tuple_data)
-
-            # Save the tid to the list of tids for the relation
-            relation_file = os.path.join(self.relation_dir, f"{tid >> 16}.dat")
-            with open(relation_file, 'ab') as rf:
-                rf.write(struct.pack('I', tid))
-
-@profile
-def find_with_value(relation: Relation, field_name: str, value: int) -> Generator[int, None, None]:
-    """Finds all tuples with the specified field value."""
+
+        self.compressed = compress
+        self.decoded_pages = {}
+        for field in self.schema:
+            field_file = os.path.join(self.field_dir, f"{field}.dat")
+            if compress:
+                if os.path.exists(field_file):
+                    os.remove(field_file)
+                os.makedirs(self.field_page_dir(field), exist_ok=True)
+                continue
+            shutil.rmtree(self.field_page_dir(field), ignore_errors=True)
+            # Field files are shared by all pages, so size them up front and let each
+            # page write its own slice; the value of tuple i lives at field offset i
+            with open(field_file, 'wb') as ff:
+                ff.truncate(total_tuples * 4)
+
+        pages = page_slices(total_tuples)
+        for _ in tqdm(run_pages(partial(self.generate_page, seed), pages, workers), total=len(pages)):
+            pass
+
+    def generate_page(self, seed: int, page: Tuple[int, int, int]) -> None:
+        """Generates and writes a single page of field values, tuples and TIDs."""
+        page_num, start, count = page
+        columns = generate_columns(self.schema, page_num, count, seed)
+
+        for field in self.schema:
+            if self.compressed:
+                # offset i lives in field page i >> 16, which is this page
+                with open(os.path.join(self.field_page_dir(field), f"{page_num}.dat"), 'wb') as ff:
+                    ff.write(encode(columns[field]))
+                continue
+            with open(os.path.join(self.field_dir, f"{field}.dat"), 'r+b') as ff:
+                ff.seek(start * 4)
+                ff.write(columns[field].tobytes())
+
+        # every field of tuple i was written at offset i
+        field_addrs = np.arange(start, start + count, dtype=np.uint32)
+        rows = np.column_stack([field_addrs] * len(self.schema))
+        with open(os.path.join(self.tuple_dir, f"{page_num}.dat"), 'wb') as tf:
+            tf.write(rows.tobytes())
+
+        with open(os.path.join(self.relation_dir, f"{page_num}.dat"), 'wb') as rf:
+            rf.write(page_tids(page_num, count).tobytes())
+
+def map_field_file(path: str) -> mmap.mmap:
+    with open(path, 'rb') as ff:
+        return mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+
+def compile_scan(relation: Relation, ranges: Dict[str, Tuple], projection: Optional[List[str]] = None) -> Callable:
+    """Compiles a scan for the tuples whose fields lie in every (low, high) range (either bound may be None).
+
+    The pipeline is called with the relation and the page numbers to scan and yields
+    the TIDs of the matches, or tuples of their projected fields. Tuple and TID pages
+    are read whole; field values are read through a memory map of each field file,
+    or from the decoded field page of a compressed relation, and only for the fields
+    the query uses (projected fields only for matches).
+    """
+    shape = codegen.query_shape(('xrd', tuple(relation.schema), relation.compressed), ranges, projection)
+    return codegen.compile_pipeline(shape, partial(_scan_source, relation.schema, relation.compressed, ranges, projection))
+
+def _scan_source(schema: List[str], compressed: bool, ranges: Dict[str, Tuple], projection: Optional[List[str]]):
+    fields = list(ranges) + [field for field in projection or () if field not in ranges]
+
+    def read(field, indent):
+        name = codegen.variable(field)
+        address = f"unpack(rows, row + {schema.index(field) * UINT.size})[0]"
+        if not compressed:
+            return [f"{indent}{name} = unpack({name}_file, {address} * {UINT.size})[0]"]
+        return [f"{indent}address = {address}",
+                f"{indent}if address >> {PAGE_BITS} != {name}_page:",
+                f"{indent}    {name}_page = address >> {PAGE_BITS}",
+                f"{indent}    {name}_values = relation.decode_field_page({field!r}, {name}_page).tolist()",
+                f"{indent}{name} = {name}_values[address & {OFFSET_MASK}]"]
+
+    # values of mapped field files are counted here, decoded field pages count their own reads
+    lines = ["def pipeline(relation, page_nums):",
+             "    with ExitStack() as files:",
+             "        values_read = 0",
+             "        files.callback(lambda: record_read(values_read * 4))"]
+    for field in fields:
+        name = codegen.variable(field)
+        if compressed:
+            lines.append(f"        {name}_page, {name}_values = -1, None")
+        else:
+            lines.append(f"        {name}_file = files.enter_context(map_field_file("
+                         f"os.path.join(relation.field_dir, {field + '.dat'!r})))")
+    lines += ["        for page_num in page_nums:",
+              "            rows = read_file(os.path.join(relation.tuple_dir, f'{page_num}.dat'))",
+              "            tids = read_file(os.path.join(relation.relation_dir, f'{page_num}.dat'))",
+              f"            values_read += len(tids) // {UINT.size} * {0 if compressed else len(ranges)}",
+              "            for (tid,) in iter_tids(tids):",
+              f"                row = (tid & {OFFSET_MASK}) * {UINT.size * len(schema)}"]
+    for field in ranges:
+        lines += read(field, ' ' * 16)
+    lines.append(f"                if {codegen.predicate_source(ranges)}:")
+    for field in fields[len(ranges):]:
+        lines += read(field, ' ' * 20)
+    if len(fields) > len(ranges) and not compressed:
+        lines.append(f"                    values_read += {len(fields) - len(ranges)}")
+    lines.append(f"                    yield {codegen.result_source(projection, 'tid')}")
+    return lines, {'os': os, 'ExitStack': ExitStack, 'map_field_file': map_field_file, 'read_file': codegen.read_file,
+                   'iter_tids': UINT.iter_unpack, 'unpack': UINT.unpack_from}
+
+@metrics.timed
+def find_with_value(relation: Relation, field_name: str, value: int, compiled: bool = True) -> Generator[int, None, None]:
+    """Finds all tuples with the specified field value.
+
+    Unless compiled=False, the scan runs as a compiled pipeline (see compile_scan).
+    """
+    if compiled:
+        yield from compile_scan(relation, {field_name: (value, value)})(relation, range(page_count(relation.N)))
+        return
     for tid in relation.scan():
         values = relation.get_tuple_values(tid)
         if values[relation.schema.index(field_name)] == value:
@@ -118,10 +303,18 @@ def main():
     # Create subcommand
     create_parser = subparsers.add_parser('create', help='Create a new relation')
     create_parser.add_argument('--N', type=int, default=100000, help='Number of tuples to generate')
+    create_parser.add_argument('--seed', type=int, default=0, help='Seed for the random data')
+    create_parser.add_argument('--workers', type=int, default=1, help='Number of processes used to generate pages')
+    create_parser.add_argument('--compress', action='store_true', help='Store field values with lightweight compression')
 
     # Benchmark subcommand (currently does nothing)
     bench_parser = subparsers.add_parser('bench', help='Run a benchmark (currently does nothing)')
     bench_parser.add_argument('--N', type=int, default=100000, help='Number of tuples to generate')
+    bench_parser.add_argument('--stats', action='store_true', help='Print I/O counters and timers for the query')
+    bench_parser.add_argument('--trace', default=None, help='Write a Chrome trace of the query to this file (needs METRICS=1)')
+    bench_parser.add_argument('--bitmap', action='store_true', help='Answer the query with a bitmap index')
+    bench_parser.add_argument('--workers', type=int, default=0, help='Run the scan in parallel across this many processes')
+    bench_parser.add_argument('--interpreted', action='store_true', help='Scan through the generic tuple-at-a-time path instead of a compiled pipeline')
 
     args = parser.parse_args()
     name = "employee"
@@ -129,12 +322,22 @@ def main():
 
     if args.command == 'create':
         relation = Relation(name, schema, args.N)
-        relation.generate()
+        relation.generate(args.seed, args.workers, args.compress)
         print(f"Relation with {args.N} tuples.")
 
     elif args.command == 'bench':
         relation = Relation(name, schema, args.N)
-        print(len(list(find_with_value(relation, 'age', 30))))
+        with metrics.collect('find_with_value', trace=args.trace is not None) as stats:
+            if args.bitmap:
+                print(len(find_with_bitmaps(relation, {'age': build_bitmap_index(relation, 'age')}, {'age': (30, 30)})))
+            elif args.workers:
+                print(len(find_with_value_parallel(relation, 'age', 30, args.workers)))
+            else:
+                print(len(list(find_with_value(relation, 'age', 30, compiled=not args.interpreted))))
+        if args.stats:
+            print(stats.report())
+        if args.trace:
+            stats.export_trace(args.trace)
 
 if __name__ == '__main__':
     main()
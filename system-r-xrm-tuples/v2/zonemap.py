@@ -0,0 +1,87 @@
+import os
+import struct
+from typing import Dict, List
+
+import numpy as np
+
+import metrics
+
+# header: number of tuples summarized; then per field: min, max, distinct hint
+HEADER_FORMAT = 'I'
+FIELD_FORMAT = 'III'
+
+
+class ZoneMap:
+    """Summary of a tuple page: min, max and a distinct-count hint for each field.
+
+    The distinct count is exact when the page is generated and becomes an
+    upper bound once tuples are appended to the page.
+    """
+
+    def __init__(self, schema: List[str], count: int = 0, mins: Dict[str, int] = None,
+                 maxs: Dict[str, int] = None, distincts: Dict[str, int] = None):
+        self.schema = schema
+        self.count = count
+        self.mins = mins or {}
+        self.maxs = maxs or {}
+        self.distincts = distincts or {field: 0 for field in schema}
+
+    @classmethod
+    def from_columns(cls, schema: List[str], columns: Dict[str, np.ndarray]) -> 'ZoneMap':
+        """Builds the zone map of a page from its column arrays."""
+        count = len(columns[schema[0]])
+        if count == 0:
+            return cls(schema)
+        return cls(schema, count,
+                   {field: int(columns[field].min()) for field in schema},
+                   {field: int(columns[field].max()) for field in schema},
+                   {field: len(np.unique(columns[field])) for field in schema})
+
+    def update(self, tuple_data: List[int]) -> None:
+        """Widens the zone map to cover a newly appended tuple."""
+        for field, value in zip(self.schema, tuple_data):
+            if self.count == 0 or value < self.mins[field] or value > self.maxs[field]:
+                # a value outside the old range is certainly new
+                self.distincts[field] += 1
+            else:
+                self.distincts[field] = min(self.distincts[field] + 1, self.maxs[field] - self.mins[field] + 1)
+            self.mins[field] = value if self.count == 0 else min(self.mins[field], value)
+            self.maxs[field] = value if self.count == 0 else max(self.maxs[field], value)
+        self.count += 1
+
+    def may_contain(self, field_name: str, value: int) -> bool:
+        """Returns False only if no tuple in the page can have field == value."""
+        return self.may_overlap(field_name, value, value)
+
+    def may_overlap(self, field_name: str, low: int, high: int) -> bool:
+        """Returns False only if no tuple in the page can have low <= field <= high."""
+        if self.count == 0:
+            return False
+        return self.mins[field_name] <= high and low <= self.maxs[field_name]
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as zf:
+            zf.write(struct.pack(HEADER_FORMAT, self.count))
+            for field in self.schema:
+                zf.write(struct.pack(FIELD_FORMAT, self.mins.get(field, 0), self.maxs.get(field, 0),
+                                     self.distincts[field]))
+
+    @classmethod
+    def load(cls, schema: List[str], path: str) -> 'ZoneMap':
+        """Loads a zone map, or returns None if the page has none."""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as zf:
+            data = zf.read()
+        metrics.record_read(len(data))
+        count = struct.unpack_from(HEADER_FORMAT, data)[0]
+        zone_map = cls(schema, count)
+        offset = struct.calcsize(HEADER_FORMAT)
+        for field in schema:
+            low, high, distinct = struct.unpack_from(FIELD_FORMAT, data, offset)
+            offset += struct.calcsize(FIELD_FORMAT)
+            zone_map.distincts[field] = distinct
+            if count:
+                zone_map.mins[field] = low
+                zone_map.maxs[field] = high
+        return zone_map